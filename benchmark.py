@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark of the readout loop
+
+Captured frames are replayed through a pseudo-terminal and read back
+through the serial transport, framer, decryption, decoding and database
+writer. Reports frames per second and the latency from the last byte of
+a frame received to the database commit.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from smartmeter.database import DatabaseWriter, init_database
+from smartmeter.dlms import decrypt, getJsonCurrent
+from smartmeter.framing import MbusFramer
+from smartmeter.transports import SimulatorTransport, loadCaptureFrames
+
+# key of the sample in reference/results_vkw.txt
+reference_key = "48704F444F326D5050553033784C3333"
+
+def percentile(values, fraction):
+    index = min(len(values) - 1, int(len(values) * fraction))
+    return values[index]
+
+def run_benchmark(capture, key, frames, realtime):
+    database_dir = tempfile.TemporaryDirectory()
+    database_file = os.path.join(database_dir.name, "benchmark.db")
+    init_database(database_file)
+    writer = DatabaseWriter(database_file)
+
+    transport = SimulatorTransport(loadCaptureFrames(capture), realtime=realtime, count=frames)
+    framer = MbusFramer()
+    latencies = []
+
+    started = time.monotonic()
+    try:
+        while len(latencies) < frames:
+            data = transport.read()
+            received = time.monotonic()
+            framer.feed(data)
+            while framer.frames:
+                plaintext = decrypt(framer.frames.popleft(), key)
+                writer.write(getJsonCurrent(plaintext))
+                latencies.append(time.monotonic() - received)
+    finally:
+        elapsed = time.monotonic() - started
+        transport.close()
+        writer.close()
+        database_dir.cleanup()
+
+    latencies.sort()
+    print(f"Frames: {len(latencies)} in {elapsed:.2f} s ({len(latencies) / elapsed:.1f} frames/s)")
+    print("Latency last byte to commit (ms): "
+          f"min {latencies[0] * 1000:.3f}, "
+          f"median {percentile(latencies, 0.5) * 1000:.3f}, "
+          f"p95 {percentile(latencies, 0.95) * 1000:.3f}, "
+          f"max {latencies[-1] * 1000:.3f}")
+    if framer.rejected_frames:
+        print(f"Rejected frames: {framer.rejected_frames}")
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the readout loop")
+    parser.add_argument("--capture", default=os.path.join(os.path.dirname(__file__), "reference", "capture_vkw.txt"),
+                        help="captured frames to replay")
+    parser.add_argument("--key", default=reference_key, help="key of the captured frames as hex")
+    parser.add_argument("--frames", type=int, default=1000, help="number of frames to replay")
+    parser.add_argument("--realtime", action="store_true", help="replay with 2400 baud timing")
+    args = parser.parse_args()
+
+    run_benchmark(args.capture, bytes.fromhex(args.key), args.frames, args.realtime)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks of the stages of the readout loop
+
+Randomized frames of several meter layouts are built with
+smartmeter.encoder and run through every stage on its own: framing,
+decryption, decoding into the frame dict, JSON serialization as sent
+by the HTTP API and the database updates. Reports frames per second of CPU time (best of several runs)
+and the memory allocated per frame (peak traced by tracemalloc, CPython
+only).
+
+With --save the results are stored as baseline. Later runs compare
+against the baseline and exit with status 1 if a stage got slower or
+allocates more than the tolerance allows.
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from smartmeter.database import DatabaseWriter, init_database
+from smartmeter.dlms import decrypt, getJsonCurrent
+from smartmeter.encoder import layouts, randomFrames
+from smartmeter.framing import MbusFramer
+
+# key of the sample in reference/results_vkw.txt
+reference_key = "48704F444F326D5050553033784C3333"
+
+# bytes per read of the serial port
+read_size = 64
+
+# operations measured for the allocations
+allocation_samples = 200
+
+def temporaryWriter():
+    """Writer on a new database, close() also removes the database"""
+    directory = tempfile.TemporaryDirectory()
+    database_file = os.path.join(directory.name, "microbenchmark.db")
+    init_database(database_file)
+    writer = DatabaseWriter(database_file)
+    def close():
+        writer.close()
+        directory.cleanup()
+    return writer, close
+
+def prepareStages(frames, key):
+    """Stage name : (items, setup), setup() returns (operation, teardown)"""
+    stream = b"".join(frames)
+    chunks = [stream[pos:pos + read_size] for pos in range(0, len(stream), read_size)]
+    plaintexts = [decrypt(frame, key) for frame in frames]
+    json_currents = [getJsonCurrent(plaintext) for plaintext in plaintexts]
+
+    def framing():
+        framer = MbusFramer()
+        def feed(chunk):
+            framer.feed(chunk)
+            framer.frames.clear()
+        return feed, None
+
+    def transaction(method):
+        # statements only, one transaction around the whole run
+        def setup():
+            writer, close = temporaryWriter()
+            writer.cursor.execute('BEGIN')
+            def teardown():
+                writer.cursor.execute('COMMIT')
+                close()
+            return getattr(writer, method), teardown
+        return setup
+
+    def write():
+        # one transaction per frame, as the readout writes
+        writer, close = temporaryWriter()
+        return writer.write, close
+
+    return {
+        "framing": (chunks, framing),
+        "decrypt": (frames, lambda: ((lambda frame: decrypt(frame, key)), None)),
+        "decode": (plaintexts, lambda: (getJsonCurrent, None)),
+        # the body of /current and the subscribers
+        "json": (json_currents, lambda: ((lambda json_current: json.dumps(json_current, default=str).encode("utf-8")), None)),
+        "current": (json_currents, transaction("updateCurrentReading")),
+        "history": (json_currents, transaction("updateHistory")),
+        "write": (json_currents, write),
+    }
+
+def measureSpeed(items, setup, frames, repeat):
+    """Frames per second of CPU time of the best run, after one warm-up run"""
+    best = None
+    for run in range(repeat + 1):
+        operation, teardown = setup()
+        # like timeit, a collection in one run would only add noise
+        gc.disable()
+        try:
+            started = time.process_time()
+            for item in items:
+                operation(item)
+            elapsed = time.process_time() - started
+        finally:
+            gc.enable()
+        if teardown:
+            teardown()
+        if run > 0:
+            best = elapsed if best is None else min(best, elapsed)
+    return frames / best
+
+def measureAllocations(items, setup, frames):
+    """Median of the peak traced memory per operation in bytes"""
+    if platform.python_implementation() != "CPython" or not hasattr(tracemalloc, "reset_peak"):
+        return None
+    operation, teardown = setup()
+    # scale operations on chunks to bytes per frame
+    scale = len(items) / frames
+    peaks = []
+    tracemalloc.start()
+    try:
+        for item in items[:allocation_samples]:
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            operation(item)
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+        if teardown:
+            teardown()
+    return statistics.median(peaks) * scale
+
+def runBenchmarks(layout_names, stages, frame_count, repeat, seed, key):
+    results = {}
+    for layout_name in layout_names:
+        frames = randomFrames(key, layout_name, frame_count, seed)
+        prepared = prepareStages(frames, key)
+        results[layout_name] = {}
+        for stage in stages:
+            items, setup = prepared[stage]
+            results[layout_name][stage] = {
+                "ops": measureSpeed(items, setup, len(frames), repeat),
+                "alloc_bytes": measureAllocations(items, setup, len(frames)),
+            }
+            result = results[layout_name][stage]
+            allocations = "-" if result["alloc_bytes"] is None else f"{result['alloc_bytes']:.0f}"
+            print(f"{layout_name:8} {stage:8} {result['ops']:12.0f} frames/s {allocations:>8} bytes/frame")
+    return results
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+    }
+
+def compareBaseline(results, baseline, tolerance):
+    """Print the changes against the baseline, returns the regressions"""
+    if baseline.get("environment") != environment():
+        print(f"Warning: baseline was recorded with {baseline.get('environment')}, now {environment()}")
+    regressions = []
+    for layout_name, stages in results.items():
+        for stage, result in stages.items():
+            reference = baseline.get("results", {}).get(layout_name, {}).get(stage)
+            if reference is None:
+                continue
+            change = result["ops"] / reference["ops"] - 1
+            line = f"{layout_name:8} {stage:8} {change * 100:+6.1f} % frames/s"
+            if change < -tolerance:
+                regressions.append(f"{layout_name} {stage}: {result['ops']:.0f} frames/s, "
+                                   f"baseline {reference['ops']:.0f}")
+            if result["alloc_bytes"] is not None and reference.get("alloc_bytes") is not None:
+                line += f", {result['alloc_bytes'] - reference['alloc_bytes']:+.0f} bytes/frame"
+                # small absolute changes are noise of the interpreter
+                if result["alloc_bytes"] > reference["alloc_bytes"] * (1 + tolerance) + 64:
+                    regressions.append(f"{layout_name} {stage}: {result['alloc_bytes']:.0f} bytes/frame, "
+                                       f"baseline {reference['alloc_bytes']:.0f}")
+            print(line)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the stages of the readout loop")
+    parser.add_argument("--layouts", default=",".join(layouts), help="meter layouts, comma separated")
+    parser.add_argument("--stages", default="framing,decrypt,decode,json,current,history,write",
+                        help="stages, comma separated")
+    parser.add_argument("--frames", type=int, default=2000, help="randomized frames per layout")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per stage, the best is reported")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random values")
+    parser.add_argument("--baseline", default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                           "microbenchmark_baseline.json"),
+                        help="baseline file")
+    parser.add_argument("--save", action="store_true", help="store the results as baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed slowdown and allocation growth as fraction (default: 0.2)")
+    args = parser.parse_args()
+
+    results = runBenchmarks(args.layouts.split(","), args.stages.split(","), args.frames, args.repeat,
+                            args.seed, bytes.fromhex(reference_key))
+
+    if args.save:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump({"environment": environment(), "frames": args.frames, "results": results},
+                      baseline_file, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, create one with --save")
+        return
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    print(f"Compared to {args.baseline}:")
+    regressions = compareBaseline(results, baseline, args.tolerance)
+    if regressions:
+        print(f"REGRESSION, more than {args.tolerance * 100:.0f} % worse than the baseline:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
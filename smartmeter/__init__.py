@@ -0,0 +1,31 @@
+#######################################
+#
+# SmartMeter readout library
+#
+# Modules:
+#   config         configuration of readout and queries
+#   dlms           decryption and decoding of the meter data
+#   framing        M-Bus framing of the serial byte stream
+#   transports     serial port, captures and the pseudo-terminal simulator
+#   encoder        builds encrypted frames, the reverse of dlms
+#   database       schema, writer and queries of the SQLite database
+#   frame_archive  archive of the raw encrypted frames, for rebuilds
+#   value_archive  columnar full resolution archive of the values
+#   backup         backup and restore of the tmpfs database
+#   events         deadband change filter and threshold event rules
+#   snapshot       latest frame in shared memory for local readers
+#   exporter       batched export in InfluxDB line protocol
+#   sync           replication of the history to a central aggregator
+#   pipeline       decoder and writer threads behind the serial reader
+#   metrics        stage latencies and counters in Prometheus format
+#   http_api       HTTP API, Server-Sent Events and WebSocket subscribers
+#   readout        readout loop and its command line, main()
+#   query          command line queries, main()
+#   analytics      NumPy reports of the query command, optional
+#
+# Importing the package has no side effects, serial port, directories
+# and database are only touched by the functions that need them.
+#
+#######################################
+
+__version__ = "1.0.0"
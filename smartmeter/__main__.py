@@ -0,0 +1,4 @@
+# python3 -m smartmeter runs the readout
+from .readout import main
+
+main()
@@ -0,0 +1,130 @@
+#######################################
+#
+# analytics.py
+#
+# Reports over longer history ranges: power profile, daily peak demand,
+# load-duration curve, import/export balance and heatmaps.
+#
+# A range is loaded with one query into NumPy arrays (seconds and energy
+# counters) and every report is computed on whole arrays. Energy counters
+# are interpolated at the interval boundaries, so the reports work on the
+# raw history as well as on the hourly rollup. Intervals with a boundary
+# inside a gap of the data are NaN and left out.
+#
+# NumPy is only needed by these reports, not by the readout.
+#
+#######################################
+
+import numpy as np
+
+from .database import history_source
+
+weekdays = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+# 1970-01-01 was a Thursday
+epoch_weekday = 3
+
+def load_history(cursor, start_time, end_time, meter_number):
+    """History of a range as (seconds, import Wh, export Wh) arrays"""
+    source = history_source(start_time)
+    cursor.execute(f'''
+        SELECT CAST(strftime('%s', timestamp) AS INTEGER), wirkenergie_bezug, wirkenergie_lieferung
+        FROM ({source})
+        WHERE timestamp >= ? AND timestamp <= ? AND meter_number IS ?
+        ORDER BY timestamp ASC
+    ''', (start_time, end_time, meter_number))
+    # NULL becomes NaN
+    data = np.array(cursor.fetchall(), dtype=np.float64).reshape(-1, 3)
+    data = data[~np.isnan(data).any(axis=1)]
+    return data[:, 0], data[:, 1], data[:, 2]
+
+def sample_step(seconds):
+    """Typical spacing of the samples in seconds"""
+    if len(seconds) < 2:
+        return 0.0
+    return float(np.median(np.diff(seconds)))
+
+def interval_grid(seconds, interval):
+    """Start of every whole interval within the range of the samples"""
+    first = np.ceil(seconds[0] / interval) * interval
+    return np.arange(first, seconds[-1] - interval + 1, interval)
+
+def interval_energy(seconds, energy, grid, interval):
+    """Energy per interval from a counter, NaN for intervals in gaps"""
+    boundaries = np.append(grid, grid[-1] + interval) if len(grid) else grid
+    counter = np.interp(boundaries, seconds, energy)
+    # a boundary is only trusted if samples lie close around it
+    index = np.clip(np.searchsorted(seconds, boundaries), 1, len(seconds) - 1)
+    gap = seconds[index] - seconds[index - 1]
+    valid = gap <= 2 * max(interval, sample_step(seconds))
+    delta = np.diff(counter)
+    delta[~(valid[:-1] & valid[1:])] = np.nan
+    return delta
+
+def power_profile(seconds, imported, exported, interval):
+    """(interval start, average import W, average export W)"""
+    if len(seconds) < 2:
+        empty = np.empty(0)
+        return empty, empty, empty
+    grid = interval_grid(seconds, interval)
+    if not len(grid):
+        empty = np.empty(0)
+        return empty, empty, empty
+    scale = 3600.0 / interval
+    return (grid,
+            interval_energy(seconds, imported, grid, interval) * scale,
+            interval_energy(seconds, exported, grid, interval) * scale)
+
+def day_groups(grid):
+    """Day numbers of the intervals and the start index of every day"""
+    days = (grid // 86400).astype(np.int64)
+    starts = np.flatnonzero(np.diff(days, prepend=days[0] - 1))
+    return days, starts
+
+def daily_peaks(grid, power):
+    """(day, peak W, start of the peak interval) for every day with data"""
+    if not len(grid):
+        return np.empty(0), np.empty(0), np.empty(0)
+    days, starts = day_groups(grid)
+    filled = np.where(np.isnan(power), -np.inf, power)
+    peaks = np.maximum.reduceat(filled, starts)
+    # index of the first interval reaching the peak of its day
+    is_peak = filled == np.repeat(peaks, np.diff(np.append(starts, len(grid))))
+    positions = np.flatnonzero(is_peak)
+    first = positions[np.searchsorted(positions, starts)]
+    keep = np.isfinite(peaks)
+    return days[starts][keep] * 86400.0, peaks[keep], grid[first][keep]
+
+def load_duration(power, fractions):
+    """Power exceeded during the given fractions of the time"""
+    power = power[~np.isnan(power)]
+    if not len(power):
+        return np.full(len(fractions), np.nan)
+    # descending, so the quantile at 1 - fraction is exceeded during fraction of the time
+    return np.quantile(power, 1.0 - np.asarray(fractions))
+
+def covered_hours(power, interval):
+    """Hours of the intervals with data"""
+    return float(np.count_nonzero(~np.isnan(power))) * interval / 3600
+
+def daily_balance(seconds, imported, exported):
+    """(day, import Wh, export Wh) between the first and last sample of every day"""
+    if len(seconds) < 2:
+        empty = np.empty(0)
+        return empty, empty, empty
+    boundaries = np.arange(np.floor(seconds[0] / 86400) * 86400, seconds[-1] + 86400, 86400)
+    boundaries = np.clip(boundaries, seconds[0], seconds[-1])
+    days = np.floor(boundaries[:-1] / 86400) * 86400
+    imported_day = np.diff(np.interp(boundaries, seconds, imported))
+    exported_day = np.diff(np.interp(boundaries, seconds, exported))
+    keep = np.diff(boundaries) > 0
+    return days[keep], imported_day[keep], exported_day[keep]
+
+def heatmap(grid, power):
+    """Average power as weekday x hour of day matrix, NaN without data"""
+    valid = ~np.isnan(power)
+    hours = (grid[valid] // 3600).astype(np.int64)
+    cells = ((hours // 24 + epoch_weekday) % 7) * 24 + hours % 24
+    sums = np.bincount(cells, weights=power[valid], minlength=7 * 24)
+    counts = np.bincount(cells, minlength=7 * 24)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (sums / counts).reshape(7, 24)
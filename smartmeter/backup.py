@@ -0,0 +1,186 @@
+#######################################
+#
+# backup.py
+#
+# The database lives on tmpfs to spare the SD card. It is restored from
+# persistent storage on startup and backed up regularly.
+#
+# The backup is incremental: a consistent snapshot of the database is
+# taken with the SQLite backup API into a staging file on tmpfs, then
+# only the pages that differ from the existing backup are written to
+# persistent storage. The previous content of these pages is saved to
+# a journal before the backup file is touched, so an interrupted backup
+# is rolled back by restore_database.
+#
+#######################################
+
+import os
+import shutil
+import sqlite3
+import time
+import zlib
+
+from . import config
+from .metrics import metrics
+
+backup_journal_magic = b'SMBJ'
+
+def ensure_directories():
+    if not os.path.exists(config.tmpfs_directory):
+        os.mkdir(config.tmpfs_directory, 0o777)
+    if not os.path.exists(config.persistent_directory):
+        os.mkdir(config.persistent_directory, 0o777)
+
+def snapshot_database():
+    """Take a consistent snapshot of the database into the staging file"""
+    src = sqlite3.connect(config.database_file)
+    dst = sqlite3.connect(config.backup_snapshot_file)
+    try:
+        # the snapshot is thrown away after the backup
+        dst.execute('PRAGMA journal_mode=OFF')
+        dst.execute('PRAGMA synchronous=OFF')
+        # copy in steps so the readout can write in between
+        src.backup(dst, pages=config.backup_step_pages, sleep=0.005)
+    finally:
+        dst.close()
+        src.close()
+
+def getPageSize(header):
+    page_size = int.from_bytes(header[16:18], byteorder='big')
+    if page_size == 1:
+        page_size = 65536
+    return page_size
+
+def writeChangedPages(source_file, target_file):
+    """Write pages of source_file that differ from target_file, returns number of pages written"""
+    with open(source_file, "rb") as source, open(target_file, "r+b") as target:
+        page_size = getPageSize(source.read(100))
+        new_size = os.fstat(source.fileno()).st_size
+        old_size = os.fstat(target.fileno()).st_size
+
+        # find changed pages
+        changed = []
+        source.seek(0)
+        for offset in range(0, max(new_size, old_size), page_size):
+            if source.read(page_size) != target.read(page_size):
+                changed.append(offset)
+        if not changed:
+            return 0
+
+        # journal old content of the changed pages
+        checksum = 0
+        with open(config.backup_journal_file, "wb") as journal:
+            journal.write(backup_journal_magic)
+            journal.write(page_size.to_bytes(4, byteorder='big'))
+            journal.write(old_size.to_bytes(8, byteorder='big'))
+            journal.write(len(changed).to_bytes(4, byteorder='big'))
+            for offset in changed:
+                target.seek(offset)
+                page = target.read(page_size)
+                entry = offset.to_bytes(8, byteorder='big') + len(page).to_bytes(4, byteorder='big') + page
+                checksum = zlib.crc32(entry, checksum)
+                journal.write(entry)
+            journal.write(checksum.to_bytes(4, byteorder='big'))
+            journal.flush()
+            os.fsync(journal.fileno())
+
+        # write changed pages
+        for offset in changed:
+            if offset >= new_size:
+                break
+            source.seek(offset)
+            target.seek(offset)
+            target.write(source.read(page_size))
+        target.truncate(new_size)
+        target.flush()
+        os.fsync(target.fileno())
+
+    os.remove(config.backup_journal_file)
+    return len(changed)
+
+def rollbackBackup():
+    """Undo an interrupted incremental backup using its journal"""
+    if not os.path.exists(config.backup_journal_file):
+        return
+    with open(config.backup_journal_file, "rb") as journal:
+        data = journal.read()
+
+    # an incomplete journal means the backup file was not touched yet
+    complete = len(data) >= 24 and data[:4] == backup_journal_magic
+    if complete:
+        old_size = int.from_bytes(data[8:16], byteorder='big')
+        count = int.from_bytes(data[16:20], byteorder='big')
+        entries = []
+        pos = 20
+        checksum = 0
+        for i in range(count):
+            if pos + 12 > len(data) - 4:
+                complete = False
+                break
+            offset = int.from_bytes(data[pos:pos + 8], byteorder='big')
+            length = int.from_bytes(data[pos + 8:pos + 12], byteorder='big')
+            checksum = zlib.crc32(data[pos:pos + 12 + length], checksum)
+            entries.append((offset, data[pos + 12:pos + 12 + length]))
+            pos += 12 + length
+        complete = complete and data[pos:pos + 4] == checksum.to_bytes(4, byteorder='big')
+
+    if complete:
+        with open(config.backup_database_file, "r+b") as target:
+            for offset, page in entries:
+                target.seek(offset)
+                target.write(page)
+            target.truncate(old_size)
+            target.flush()
+            os.fsync(target.fileno())
+        print("Interrupted backup rolled back")
+    os.remove(config.backup_journal_file)
+
+def backup_database():
+    """Incrementally back up the database from tmpfs to persistent storage"""
+    started = time.perf_counter()
+    try:
+        if not os.path.exists(config.database_file):
+            return
+        snapshot_database()
+        if os.path.exists(config.backup_database_file):
+            pages = writeChangedPages(config.backup_snapshot_file, config.backup_database_file)
+            metrics.increment("backup_pages_written", pages)
+            print(f"Database backed up to {config.backup_database_file} ({pages} pages written)")
+        else:
+            # first backup, write a complete copy
+            shutil.copyfile(config.backup_snapshot_file, config.backup_database_file + ".tmp")
+            os.replace(config.backup_database_file + ".tmp", config.backup_database_file)
+            print(f"Database backed up to {config.backup_database_file}")
+        duration = time.perf_counter() - started
+        metrics.observe("backup", duration)
+        metrics.set("backup_last_duration_seconds", duration)
+        metrics.set("backup_last_success_time_seconds", time.time())
+    except Exception as e:
+        metrics.increment("backup_failures")
+        print(f"Error backing up database: {e}")
+    finally:
+        if os.path.exists(config.backup_snapshot_file):
+            os.remove(config.backup_snapshot_file)
+
+def backupLoop():
+    # runs in its own thread, off the readout loop
+    while True:
+        time.sleep(config.backup_interval_minutes * 60)
+        backup_database()
+
+def restore_database():
+    """Restore database from persistent storage to tmpfs"""
+    try:
+        rollbackBackup()
+        if os.path.exists(config.backup_database_file):
+            # copy next to the database and swap it in atomically
+            shutil.copyfile(config.backup_database_file, config.database_file + ".tmp")
+            for suffix in ("-wal", "-shm"):
+                if os.path.exists(config.database_file + suffix):
+                    os.remove(config.database_file + suffix)
+            os.replace(config.database_file + ".tmp", config.database_file)
+            print(f"Database restored from {config.backup_database_file}")
+        else:
+            print("No backup database found, starting fresh")
+    except Exception as e:
+        print(f"Error restoring database: {e}")
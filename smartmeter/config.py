@@ -0,0 +1,78 @@
+#######################################
+#
+# config.py
+#
+# Configuration of the readout and the query tools. The values are read
+# when they are used, so they can be changed after import, e.g. to point
+# the database at a temporary file.
+#
+#######################################
+
+history_keep_hours = 24
+hostory_update_minutes = 1
+backup_interval_minutes = 5
+tmpfs_directory = "/ram"
+persistent_directory = "/home/pi/smartmeter_data"
+database_file = "/ram/smartmeter.db"
+backup_database_file = "/home/pi/smartmeter_data/smartmeter.db"
+backup_snapshot_file = "/ram/smartmeter.db.snapshot"
+backup_journal_file = "/home/pi/smartmeter_data/smartmeter.db-pages"
+backup_step_pages = 256
+current_reading_interval = 0 # seconds between current_readings updates, e.g. 60 when local readers use the snapshot
+snapshot_enabled = True
+snapshot_file = "/ram/smartmeter.shm"
+archive_enabled = False # full resolution value archive on the SD card
+archive_directory = "/home/pi/smartmeter_data/archive"
+frame_archive_enabled = False
+frame_archive_directory = "/home/pi/smartmeter_data/frames"
+http_port = None # HTTP API disabled
+http_host = "127.0.0.1"
+export_url = None # e.g. "http://influxdb:8086/api/v2/write?org=home&bucket=smartmeter&precision=s"
+export_token = None
+export_batch_size = 500 # lines per request
+export_flush_seconds = 60
+export_queue_size = 10000
+export_spool_file = "/home/pi/smartmeter_data/export.spool"
+export_spool_max_bytes = 64 * 1024 * 1024
+export_timeout_seconds = 10
+metrics_port = None # metrics endpoint disabled
+metrics_file = None # e.g. "/ram/smartmeter.prom" for the node_exporter textfile collector
+sync_url = None # e.g. "http://central:8090/sync", replication to the aggregator disabled
+sync_token = None
+sync_site = None # name of this site, default: host name
+sync_interval_minutes = 5
+sync_batch_rows = 5000 # rows per request
+sync_state_file = "/home/pi/smartmeter_data/sync_state.json"
+sync_timeout_seconds = 30
+sync_aggregator_port = 8090
+sync_aggregator_database = "/home/pi/smartmeter_data/central.db"
+pipeline_frame_queue_size = 64 # received frames waiting for the decoder
+pipeline_decoded_queue_size = 256 # decoded frames waiting for the writer
+serial_port = "/dev/ttyS0"
+serial_baudrate = 2400
+key_file = "key.txt"
+change_filter_enabled = True # skip current_readings updates of frames within the deadbands
+change_deadbands = {
+    # name in the frame : largest change that is not written
+    "Wirkenergie A+": 10, # Wh
+    "Wirkenergie A-": 10,
+    "Blindenergie Q+": 10, # varh
+    "Blindenergie Q-": 10,
+    "Wirkleistung P+": 10, # W
+    "Wirkleistung P-": 10,
+    "Spannung L1": 1.0, # V
+    "Spannung L2": 1.0,
+    "Spannung L3": 1.0,
+    "Strom L1": 0.05, # A
+    "Strom L2": 0.05,
+    "Strom L3": 0.05,
+    "Leistungsfaktor": 0.01,
+}
+change_max_age_seconds = 60 # write at least this often
+# parameters: above/below (limit), deviation (relative limit, nominal), imbalance (relative limit, minimum mean)
+event_rules = [
+    # name              , condition  , fields                                          , parameters , seconds
+    ("power_high",        "above",     ["Wirkleistung P+"],                              (10000,),    60),
+    ("voltage_deviation", "deviation", ["Spannung L1", "Spannung L2", "Spannung L3"],   (0.10, 230), 10),
+    ("current_imbalance", "imbalance", ["Strom L1", "Strom L2", "Strom L3"],            (0.5, 2.0),  300),
+]
@@ -0,0 +1,717 @@
+#######################################
+#
+# database.py
+#
+# Data access layer shared by the readout and the query tools: schema,
+# the writer used by the readout loop and the read queries.
+#
+#######################################
+
+from datetime import datetime, timedelta
+import fcntl
+import itertools
+import sqlite3
+import time
+
+from . import config
+from .metrics import metrics
+
+#######################################
+# Schema
+
+field_columns = [
+    # name in the frame , column of current_readings
+    ("Wirkenergie A+",   "wirkenergie_bezug"),
+    ("Wirkenergie A-",   "wirkenergie_lieferung"),
+    ("Wirkleistung P+",  "wirkleistung_bezug"),
+    ("Wirkleistung P-",  "wirkleistung_lieferung"),
+    ("Blindenergie Q+",  "blindenergie_bezug"),
+    ("Blindenergie Q-",  "blindenergie_lieferung"),
+    ("Spannung L1",      "spannung_l1"),
+    ("Spannung L2",      "spannung_l2"),
+    ("Spannung L3",      "spannung_l3"),
+    ("Strom L1",         "strom_l1"),
+    ("Strom L2",         "strom_l2"),
+    ("Strom L3",         "strom_l3"),
+    ("Leistungsfaktor",  "leistungsfaktor"),
+]
+
+# meter timestamps are local time without time zone, counted like SQLite's strftime('%s')
+history_epoch = datetime(1970, 1, 1)
+
+rollup_tables = [
+    # table           , start of the period containing a timestamp
+    ("history_hourly",  lambda t: t.replace(minute=0, second=0, microsecond=0)),
+    ("history_daily",   lambda t: t.replace(hour=0, minute=0, second=0, microsecond=0)),
+    ("history_monthly", lambda t: t.replace(day=1, hour=0, minute=0, second=0, microsecond=0)),
+]
+
+def history_interval_seconds():
+    return 60 * config.hostory_update_minutes
+
+def history_slots():
+    """Number of history entries kept per meter"""
+    return max(1, int(config.history_keep_hours * 3600) // history_interval_seconds())
+
+def history_bucket(timestamp):
+    """Number of the history interval containing a meter timestamp, counted from 1970"""
+    return int((timestamp - history_epoch).total_seconds()) // history_interval_seconds()
+
+# a newer entry replaces the entry in its slot, older data never replaces newer
+sql_history_conflict = '''
+    ON CONFLICT(meter_number, slot) DO UPDATE SET
+        timestamp = excluded.timestamp,
+        wirkenergie_bezug = excluded.wirkenergie_bezug,
+        wirkenergie_lieferung = excluded.wirkenergie_lieferung
+    WHERE excluded.timestamp >= history.timestamp
+'''
+
+def lock_database(database_file=None):
+    """Lock the database for this process, None if another process holds the lock.
+
+    The readout and the rebuild hold the lock while they run, the lock is
+    released when the returned file is closed or the process ends.
+    """
+    lock_file = open((database_file or config.database_file) + ".lock", "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
+
+# start of the period of a timestamp in SQL, like the periods of rollup_tables
+rollup_periods = {
+    "history_hourly":  "strftime('%Y-%m-%d %H:00:00', timestamp)",
+    "history_daily":   "strftime('%Y-%m-%d 00:00:00', timestamp)",
+    "history_monthly": "strftime('%Y-%m-01 00:00:00', timestamp)",
+}
+
+# rollups of the history entries, the history has no power values.
+# first and last are the first and last entries with a value, like the writer
+sql_backfill_rollup = '''
+    INSERT INTO {table} (
+        meter_number, period_start, samples,
+        first_timestamp, last_timestamp,
+        wirkenergie_bezug_first, wirkenergie_bezug_last,
+        wirkenergie_bezug_min, wirkenergie_bezug_max,
+        wirkenergie_lieferung_first, wirkenergie_lieferung_last,
+        wirkenergie_lieferung_min, wirkenergie_lieferung_max,
+        wirkleistung_bezug_samples, wirkleistung_lieferung_samples
+    )
+    SELECT meter_number, period_start, COUNT(*),
+           MIN(timestamp), MAX(timestamp),
+           MAX(bezug_first), MAX(bezug_last),
+           MIN(wirkenergie_bezug), MAX(wirkenergie_bezug),
+           MAX(lieferung_first), MAX(lieferung_last),
+           MIN(wirkenergie_lieferung), MAX(wirkenergie_lieferung),
+           0, 0
+    FROM (
+        SELECT meter_number, {period} AS period_start, timestamp, wirkenergie_bezug, wirkenergie_lieferung,
+               first_value(wirkenergie_bezug) OVER (
+                   PARTITION BY meter_number, {period} ORDER BY wirkenergie_bezug IS NULL, timestamp) AS bezug_first,
+               first_value(wirkenergie_bezug) OVER (
+                   PARTITION BY meter_number, {period} ORDER BY wirkenergie_bezug IS NULL, timestamp DESC) AS bezug_last,
+               first_value(wirkenergie_lieferung) OVER (
+                   PARTITION BY meter_number, {period} ORDER BY wirkenergie_lieferung IS NULL, timestamp) AS lieferung_first,
+               first_value(wirkenergie_lieferung) OVER (
+                   PARTITION BY meter_number, {period} ORDER BY wirkenergie_lieferung IS NULL, timestamp DESC) AS lieferung_last
+        FROM history
+    )
+    GROUP BY meter_number, period_start
+'''
+
+# Initialize database
+def init_database(database_file=None):
+    conn = sqlite3.connect(database_file or config.database_file)
+    cursor = conn.cursor()
+    
+    # Create current readings table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS current_readings (
+            id INTEGER PRIMARY KEY,
+            timestamp DATETIME,
+            meter_number TEXT,
+            logical_device_name TEXT,
+            wirkenergie_bezug REAL,
+            wirkenergie_lieferung REAL,
+            wirkleistung_bezug REAL,
+            wirkleistung_lieferung REAL,
+            blindenergie_bezug REAL,
+            blindenergie_lieferung REAL,
+            spannung_l1 REAL,
+            spannung_l2 REAL,
+            spannung_l3 REAL,
+            strom_l1 REAL,
+            strom_l2 REAL,
+            strom_l3 REAL,
+            leistungsfaktor REAL
+        )
+    ''')
+    
+    # The history is a ring: every meter has history_slots() slots, one per
+    # history interval of the retention window. A new entry overwrites the
+    # slot of the entry one window older, so there is nothing to prune.
+    slots = history_slots()
+    cursor.execute('CREATE TABLE IF NOT EXISTS retention (table_name TEXT PRIMARY KEY, slots INTEGER)')
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(history)')]
+    stored_slots = cursor.execute("SELECT slots FROM retention WHERE table_name = 'history'").fetchone()
+    # History tables of older versions have no slots, a changed retention
+    # moves the entries to other slots. The entries are copied in both cases.
+    migrate_history = len(columns) > 0 and ("slot" not in columns or stored_slots is None or stored_slots[0] != slots)
+    if migrate_history:
+        cursor.execute('DROP INDEX IF EXISTS idx_history_timestamp')
+        cursor.execute('DROP INDEX IF EXISTS idx_history_meter_timestamp')
+        cursor.execute('ALTER TABLE history RENAME TO history_old')
+
+    # Create history table - stores absolute energy values over time
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS history (
+            meter_number TEXT,
+            slot INTEGER,
+            timestamp DATETIME,
+            wirkenergie_bezug REAL,
+            wirkenergie_lieferung REAL,
+            PRIMARY KEY (meter_number, slot)
+        ) WITHOUT ROWID
+    ''')
+
+    if migrate_history:
+        # the first versions had no meter_number, entries belong to the current meter
+        meter_number = "meter_number" if "meter_number" in columns else "(SELECT meter_number FROM current_readings LIMIT 1)"
+        cursor.execute(f'''
+            INSERT INTO history (meter_number, slot, timestamp, wirkenergie_bezug, wirkenergie_lieferung)
+            SELECT {meter_number},
+                   (CAST(strftime('%s', timestamp) AS INTEGER) / ?) % ?,
+                   timestamp, wirkenergie_bezug, wirkenergie_lieferung
+            FROM history_old WHERE true
+            ORDER BY timestamp
+            {sql_history_conflict}
+        ''', (history_interval_seconds(), slots))
+        cursor.execute('DROP TABLE history_old')
+    cursor.execute('INSERT OR REPLACE INTO retention (table_name, slots) VALUES (?, ?)', ('history', slots))
+    
+    # Remove the last_values table as it's no longer needed
+    # cursor.execute('DROP TABLE IF EXISTS last_values')
+    
+    # Create index on meter and timestamp for the range queries
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_history_meter_timestamp ON history(meter_number, timestamp)')
+
+    # Create events table - threshold events of the event rules, end is NULL while active
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY,
+            meter_number TEXT,
+            rule TEXT,
+            start_timestamp DATETIME,
+            end_timestamp DATETIME,
+            peak_value REAL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_events_meter_start ON events(meter_number, start_timestamp)')
+
+    # Create rollup tables - aggregated history, kept when history is pruned
+    for table, _ in rollup_tables:
+        created = cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is None
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                meter_number TEXT,
+                period_start DATETIME,
+                samples INTEGER,
+                first_timestamp DATETIME,
+                last_timestamp DATETIME,
+                wirkenergie_bezug_first REAL,
+                wirkenergie_bezug_last REAL,
+                wirkenergie_bezug_min REAL,
+                wirkenergie_bezug_max REAL,
+                wirkenergie_lieferung_first REAL,
+                wirkenergie_lieferung_last REAL,
+                wirkenergie_lieferung_min REAL,
+                wirkenergie_lieferung_max REAL,
+                wirkleistung_bezug_avg REAL,
+                wirkleistung_bezug_max REAL,
+                wirkleistung_lieferung_avg REAL,
+                wirkleistung_lieferung_max REAL,
+                wirkleistung_bezug_samples INTEGER,
+                wirkleistung_lieferung_samples INTEGER,
+                PRIMARY KEY (meter_number, period_start)
+            )
+        ''')
+        if created:
+            # databases of older versions have history without rollups
+            cursor.execute(sql_backfill_rollup.format(table=table, period=rollup_periods[table]))
+        rollup_columns = [row[1] for row in cursor.execute(f'PRAGMA table_info({table})')]
+        if "wirkleistung_bezug_samples" not in rollup_columns:
+            # the averages of older versions are over all samples of the period
+            for column in ("wirkleistung_bezug", "wirkleistung_lieferung"):
+                cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column}_samples INTEGER')
+                cursor.execute(f'UPDATE {table} SET {column}_samples = CASE WHEN {column}_avg IS NULL THEN 0 ELSE samples END')
+    
+    conn.commit()
+    conn.close()
+
+#######################################
+# Writer
+
+# SQL statements of the writer, kept constant so the connection's
+# statement cache can reuse the prepared statements
+sql_delete_current = 'DELETE FROM current_readings WHERE meter_number IS ?'
+sql_insert_current = '''
+    INSERT INTO current_readings (
+        timestamp, meter_number, logical_device_name,
+        wirkenergie_bezug, wirkenergie_lieferung,
+        wirkleistung_bezug, wirkleistung_lieferung,
+        blindenergie_bezug, blindenergie_lieferung,
+        spannung_l1, spannung_l2, spannung_l3,
+        strom_l1, strom_l2, strom_l3, leistungsfaktor
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+sql_last_history = '''
+    SELECT timestamp FROM history 
+    WHERE meter_number IS ?
+    ORDER BY timestamp DESC 
+    LIMIT 1
+'''
+sql_insert_history = '''
+    INSERT INTO history (
+        meter_number,
+        slot,
+        timestamp, 
+        wirkenergie_bezug, 
+        wirkenergie_lieferung
+    ) VALUES (?, ?, ?, ?, ?)
+''' + sql_history_conflict
+sql_update_rollup = '''
+    INSERT INTO {table} (
+        meter_number, period_start, samples,
+        first_timestamp, last_timestamp,
+        wirkenergie_bezug_first, wirkenergie_bezug_last,
+        wirkenergie_bezug_min, wirkenergie_bezug_max,
+        wirkenergie_lieferung_first, wirkenergie_lieferung_last,
+        wirkenergie_lieferung_min, wirkenergie_lieferung_max,
+        wirkleistung_bezug_avg, wirkleistung_bezug_max,
+        wirkleistung_lieferung_avg, wirkleistung_lieferung_max,
+        wirkleistung_bezug_samples, wirkleistung_lieferung_samples
+    ) VALUES (?, ?, 1, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(meter_number, period_start) DO UPDATE SET
+        samples = samples + 1,
+        last_timestamp = excluded.last_timestamp,
+        {energy_updates},
+        {power_updates}
+'''
+# a frame without a value keeps the aggregates of the others, SQLite's
+# min() and max() with a NULL argument would return NULL
+sql_rollup_energy = '''
+        {column}_first = coalesce({column}_first, excluded.{column}_first),
+        {column}_last = coalesce(excluded.{column}_last, {column}_last),
+        {column}_min = coalesce(min({column}_min, excluded.{column}_min), {column}_min, excluded.{column}_min),
+        {column}_max = coalesce(max({column}_max, excluded.{column}_max), {column}_max, excluded.{column}_max)'''
+# the average is over the samples with a value
+sql_rollup_power = '''
+        {column}_avg = CASE
+            WHEN excluded.{column}_avg IS NULL THEN {column}_avg
+            WHEN {column}_avg IS NULL THEN excluded.{column}_avg
+            ELSE {column}_avg + (excluded.{column}_avg - {column}_avg) / ({column}_samples + 1) END,
+        {column}_max = coalesce(max({column}_max, excluded.{column}_max), {column}_max, excluded.{column}_max),
+        {column}_samples = {column}_samples + excluded.{column}_samples'''
+sql_update_rollups = [(sql_update_rollup.format(
+    table=table,
+    energy_updates=",".join(sql_rollup_energy.format(column=column)
+                            for column in ("wirkenergie_bezug", "wirkenergie_lieferung")).strip(),
+    power_updates=",".join(sql_rollup_power.format(column=column)
+                           for column in ("wirkleistung_bezug", "wirkleistung_lieferung")).strip()), period)
+    for table, period in rollup_tables]
+
+def rollupParameters(json_current, period):
+    current_timestamp = json_current["Datum"]["value"]
+    energy_bezug = json_current.get("Wirkenergie A+", {}).get("value")
+    energy_lieferung = json_current.get("Wirkenergie A-", {}).get("value")
+    power_bezug = json_current.get("Wirkleistung P+", {}).get("value")
+    power_lieferung = json_current.get("Wirkleistung P-", {}).get("value")
+    return (
+        json_current.get("Zaehlernummer", {}).get("value"), period(current_timestamp),
+        current_timestamp, current_timestamp,
+        energy_bezug, energy_bezug, energy_bezug, energy_bezug,
+        energy_lieferung, energy_lieferung, energy_lieferung, energy_lieferung,
+        power_bezug, power_bezug,
+        power_lieferung, power_lieferung,
+        int(power_bezug is not None), int(power_lieferung is not None)
+    )
+
+class DatabaseWriter:
+    """Long-lived database connection used by the readout loop.
+
+    The database runs in WAL mode so readers like query_database.py
+    never block the writer. All changes of one frame are written in a
+    single transaction.
+    """
+
+    def __init__(self, database_file=None, change_filter=None):
+        # autocommit mode, transactions are handled explicitly.
+        # created by the main thread, used by the writer thread of the pipeline
+        self.conn = sqlite3.connect(database_file or config.database_file, isolation_level=None, cached_statements=16,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        # the database lives on tmpfs, durability comes from the backup
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA cache_size=-1024') # 1 MiB
+        self.conn.execute('PRAGMA temp_store=MEMORY')
+        self.cursor = self.conn.cursor()
+        # number of history entries written, used to invalidate caches
+        self.history_changes = 0
+        # meter number : time.perf_counter() of the last current_readings update
+        self.current_updated = {}
+        # skips current_readings updates of frames without relevant changes
+        self.change_filter = change_filter
+        # meter number : history_bucket() of the last history entry, read once per meter
+        self.last_buckets = {}
+        self.slots = history_slots()
+
+    def write(self, json_current):
+        """Store current reading and history entry of one frame"""
+        cursor = self.cursor
+        try:
+            started = time.perf_counter()
+            cursor.execute('BEGIN')
+            # with the shared snapshot as live source the row can be updated less often,
+            # frames without a due update or history entry then do not write at all
+            meter_number = json_current.get("Zaehlernummer", {}).get("value")
+            update_current = started - self.current_updated.get(meter_number, -float("inf")) >= config.current_reading_interval
+            if update_current and self.change_filter is not None and not self.change_filter.changed(json_current):
+                # all values within their deadbands
+                update_current = False
+                metrics.increment("current_readings_unchanged")
+            if update_current:
+                self.updateCurrentReading(json_current)
+            current = time.perf_counter()
+            self.updateHistory(json_current)
+            history = time.perf_counter()
+            cursor.execute('COMMIT')
+            if update_current:
+                self.current_updated[meter_number] = started
+                metrics.observe("update_current_reading", current - started)
+            metrics.observe("update_history", history - current)
+            metrics.observe("commit", time.perf_counter() - history)
+        except Exception as e:
+            metrics.increment("database_errors")
+            print(f"Error writing database: {e}")
+            if self.conn.in_transaction:
+                cursor.execute('ROLLBACK')
+            # the cached state may include the rolled back entries
+            self.last_buckets = {}
+            if self.change_filter is not None:
+                self.change_filter.reset()
+
+    def lastBucket(self, meter_number):
+        last_bucket = self.last_buckets.get(meter_number, False)
+        if last_bucket is False:
+            self.cursor.execute(sql_last_history, (meter_number,))
+            last_entry = self.cursor.fetchone()
+            last_bucket = history_bucket(datetime.fromisoformat(last_entry[0])) if last_entry else None
+            self.last_buckets[meter_number] = last_bucket
+        return last_bucket
+
+    def historyParameters(self, json_current, bucket):
+        return (
+            json_current.get("Zaehlernummer", {}).get("value"),
+            bucket % self.slots,
+            json_current["Datum"]["value"],
+            json_current.get("Wirkenergie A+", {}).get("value"),
+            json_current.get("Wirkenergie A-", {}).get("value")
+        )
+
+    def writeBatch(self, json_currents):
+        """Store many frames in chronological order in one transaction.
+        
+        Like write() only frames after the newest history entry of their
+        meter add entries, older frames are skipped. Backfills therefore
+        write into a fresh database (see readout.rebuildDatabase).
+        Returns the number of history entries written.
+        """
+        cursor = self.cursor
+        latest = {}
+        history = []
+        try:
+            cursor.execute('BEGIN')
+            for json_current in json_currents:
+                meter_number = json_current.get("Zaehlernummer", {}).get("value")
+                latest[meter_number] = json_current
+
+                # Only update history once per history interval
+                bucket = history_bucket(json_current["Datum"]["value"])
+                last_bucket = self.lastBucket(meter_number)
+                if last_bucket is None or bucket > last_bucket:
+                    history.append((json_current, bucket))
+                    self.last_buckets[meter_number] = bucket
+
+            for json_current in latest.values():
+                self.updateCurrentReading(json_current)
+            cursor.executemany(sql_insert_history, [self.historyParameters(json_current, bucket)
+                                                    for json_current, bucket in history])
+            for sql, period in sql_update_rollups:
+                cursor.executemany(sql, [rollupParameters(json_current, period) for json_current, bucket in history])
+            cursor.execute('COMMIT')
+            self.history_changes += len(history)
+            return len(history)
+        except Exception as e:
+            metrics.increment("database_errors")
+            print(f"Error writing database: {e}")
+            if self.conn.in_transaction:
+                cursor.execute('ROLLBACK')
+            self.last_buckets = {}
+            return 0
+
+    def updateCurrentReading(self, json_current):
+        # Clear previous current reading of this meter (keep only the latest)
+        self.cursor.execute(sql_delete_current, (json_current.get("Zaehlernummer", {}).get("value"),))
+
+        # Insert new current reading
+        self.cursor.execute(sql_insert_current, (
+            json_current.get("Datum", {}).get("value"),
+            json_current.get("Zaehlernummer", {}).get("value"),
+            json_current.get("Logical Device Name", {}).get("value"),
+            json_current.get("Wirkenergie A+", {}).get("value"),
+            json_current.get("Wirkenergie A-", {}).get("value"),
+            json_current.get("Wirkleistung P+", {}).get("value"),
+            json_current.get("Wirkleistung P-", {}).get("value"),
+            json_current.get("Blindenergie Q+", {}).get("value"),
+            json_current.get("Blindenergie Q-", {}).get("value"),
+            json_current.get("Spannung L1", {}).get("value"),
+            json_current.get("Spannung L2", {}).get("value"),
+            json_current.get("Spannung L3", {}).get("value"),
+            json_current.get("Strom L1", {}).get("value"),
+            json_current.get("Strom L2", {}).get("value"),
+            json_current.get("Strom L3", {}).get("value"),
+            json_current.get("Leistungsfaktor", {}).get("value")
+        ))
+
+    def updateHistory(self, json_current):
+        meter_number = json_current.get("Zaehlernummer", {}).get("value")
+
+        # Only update history once per history interval (every minute),
+        # the last interval is cached, no query per frame
+        bucket = history_bucket(json_current["Datum"]["value"])
+        last_bucket = self.lastBucket(meter_number)
+        if last_bucket is not None and bucket <= last_bucket:
+            return
+
+        # Insert new history entry with absolute energy values, it replaces
+        # the entry one retention window older in the same slot
+        self.cursor.execute(sql_insert_history, self.historyParameters(json_current, bucket))
+        self.last_buckets[meter_number] = bucket
+
+        self.history_changes += 1
+        for sql, period in sql_update_rollups:
+            self.cursor.execute(sql, rollupParameters(json_current, period))
+
+    def close(self):
+        self.conn.close()
+
+#######################################
+# Queries
+
+rollup_resolutions = [
+    # table          , hours per period
+    ("history_monthly", 24 * 30),
+    ("history_daily",   24),
+    ("history_hourly",  1),
+]
+
+def connect_database(database_file=None):
+    """Connect to the database and return connection"""
+    try:
+        conn = sqlite3.connect(database_file or config.database_file)
+        conn.row_factory = sqlite3.Row  # This allows column access by name
+        return conn
+    except Exception as e:
+        print(f"Error connecting to database: {e}")
+        return None
+
+def get_current_reading():
+    """Get the current/latest reading"""
+    conn = connect_database()
+    if not conn:
+        return None
+    
+    cursor = conn.cursor()
+    cursor.execute('SELECT * FROM current_readings ORDER BY timestamp DESC LIMIT 1')
+    result = cursor.fetchone()
+    conn.close()
+    
+    if result:
+        return dict(result)
+    return None
+
+def get_current_readings():
+    """Get the latest reading of every meter"""
+    conn = connect_database()
+    if not conn:
+        return []
+    
+    cursor = conn.cursor()
+    cursor.execute('SELECT * FROM current_readings ORDER BY meter_number')
+    results = cursor.fetchall()
+    conn.close()
+    
+    return [dict(row) for row in results]
+
+def get_history(hours=24, meter_number=None):
+    """Get historical data for the specified number of hours"""
+    conn = connect_database()
+    if not conn:
+        return []
+    
+    cursor = conn.cursor()
+    threshold_time = datetime.now() - timedelta(hours=hours)
+    if meter_number is None:
+        # default to the meter of the latest reading
+        meter_number = get_latest_meter_number(cursor)
+    cursor.execute('''
+        SELECT * FROM history 
+        WHERE timestamp >= ? AND meter_number IS ?
+        ORDER BY timestamp ASC
+    ''', (threshold_time, meter_number))
+    
+    results = cursor.fetchall()
+    conn.close()
+    
+    return [dict(row) for row in results]
+
+def get_events(hours=24, meter_number=None):
+    """Get the events that were active in the specified number of hours"""
+    conn = connect_database()
+    if not conn:
+        return []
+    
+    cursor = conn.cursor()
+    threshold_time = datetime.now() - timedelta(hours=hours)
+    if meter_number is None:
+        meter_number = get_latest_meter_number(cursor)
+    cursor.execute('''
+        SELECT * FROM events
+        WHERE (end_timestamp IS NULL OR end_timestamp >= ?) AND meter_number IS ?
+        ORDER BY start_timestamp ASC
+    ''', (threshold_time, meter_number))
+    
+    results = cursor.fetchall()
+    conn.close()
+    
+    return [dict(row) for row in results]
+
+def get_latest_meter_number(cursor):
+    cursor.execute('SELECT meter_number FROM current_readings ORDER BY timestamp DESC LIMIT 1')
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def select_rollup(hours):
+    """Coarsest rollup table with at least 24 periods in the requested range"""
+    for table, period_hours in rollup_resolutions:
+        if hours >= period_hours * 24:
+            return table
+    return rollup_resolutions[-1][0]
+
+def get_rollup(hours=24, meter_number=None, table=None):
+    """Get aggregated history for the specified number of hours"""
+    conn = connect_database()
+    if not conn:
+        return []
+    
+    cursor = conn.cursor()
+    if table is None:
+        table = select_rollup(hours)
+    if meter_number is None:
+        meter_number = get_latest_meter_number(cursor)
+    threshold_time = datetime.now() - timedelta(hours=hours)
+    cursor.execute(f'''
+        SELECT * FROM {table}
+        WHERE last_timestamp >= ? AND meter_number IS ?
+        ORDER BY period_start ASC
+    ''', (threshold_time, meter_number))
+    
+    results = cursor.fetchall()
+    conn.close()
+    
+    return [dict(row) for row in results]
+
+def history_source(start_time):
+    """Raw history if it still covers start_time, otherwise the hourly rollup"""
+    if start_time >= datetime.now() - timedelta(hours=config.history_keep_hours):
+        return 'SELECT timestamp, meter_number, wirkenergie_bezug, wirkenergie_lieferung FROM history'
+    return '''
+        SELECT last_timestamp AS timestamp, meter_number,
+               wirkenergie_bezug_last AS wirkenergie_bezug,
+               wirkenergie_lieferung_last AS wirkenergie_lieferung
+        FROM history_hourly
+    '''
+
+def query_history_range(cursor, start_time, end_time, meter_number, points=None):
+    """Execute a history query between start_time and end_time.
+    
+    With points the range is split into that many time buckets and the
+    minimum and maximum of every bucket is returned, grouped by SQLite.
+    """
+    source = history_source(start_time)
+    if not points:
+        cursor.execute(f'''
+            SELECT timestamp, wirkenergie_bezug, wirkenergie_lieferung FROM ({source})
+            WHERE timestamp >= ? AND timestamp <= ? AND meter_number IS ?
+            ORDER BY timestamp ASC
+        ''', (start_time, end_time, meter_number))
+        return cursor
+    
+    # buckets per day
+    scale = points / max((end_time - start_time).total_seconds() / 86400, 1e-9)
+    cursor.execute(f'''
+        SELECT min(timestamp) AS timestamp, count(*) AS samples,
+               min(wirkenergie_bezug) AS wirkenergie_bezug_min,
+               max(wirkenergie_bezug) AS wirkenergie_bezug_max,
+               min(wirkenergie_lieferung) AS wirkenergie_lieferung_min,
+               max(wirkenergie_lieferung) AS wirkenergie_lieferung_max
+        FROM ({source})
+        WHERE timestamp >= ? AND timestamp <= ? AND meter_number IS ?
+        GROUP BY CAST((julianday(timestamp) - julianday(?)) * ? AS INTEGER)
+        ORDER BY 1 ASC
+    ''', (start_time, end_time, meter_number, start_time, scale))
+    return cursor
+
+def query_history_lttb(cursor, start_time, end_time, meter_number, points, field):
+    """Downsample history to about points rows with largest triangle three buckets.
+    
+    Rows are read from the cursor in a single pass, only the current and
+    the following bucket are held in memory.
+    """
+    source = history_source(start_time)
+    scale = points / max((end_time - start_time).total_seconds() / 86400, 1e-9)
+    cursor.execute(f'''
+        SELECT CAST((julianday(timestamp) - julianday(?)) * ? AS INTEGER) AS bucket,
+               julianday(timestamp) AS x, coalesce({field}, 0) AS y,
+               timestamp, wirkenergie_bezug, wirkenergie_lieferung
+        FROM ({source})
+        WHERE timestamp >= ? AND timestamp <= ? AND meter_number IS ?
+        ORDER BY timestamp ASC
+    ''', (start_time, scale, start_time, end_time, meter_number))
+    
+    buckets = (list(group) for _, group in itertools.groupby(cursor, key=lambda row: row[0]))
+    current = next(buckets, None)
+    if current is None:
+        return
+    
+    # first point is always kept
+    selected = current[0]
+    yield selected[3:]
+    current = current[1:]
+    
+    for following in buckets:
+        if current:
+            average_x = sum(row[1] for row in following) / len(following)
+            average_y = sum(row[2] for row in following) / len(following)
+            # point forming the largest triangle with the selected point and the following average
+            selected = max(current, key=lambda row: abs(
+                (selected[1] - average_x) * (row[2] - selected[2]) -
+                (selected[1] - row[1]) * (average_y - selected[2])))
+            yield selected[3:]
+        current = following
+    
+    # last point is always kept
+    if current:
+        yield current[-1][3:]
@@ -0,0 +1,253 @@
+#######################################
+#
+# dlms.py
+#
+# Decryption and decoding of the DLMS/COSEM DataNotification sent by
+# the meter. Decoded frames are dicts of name : {"value", "unit"}.
+#
+#######################################
+
+from Crypto.Cipher import AES
+from enum import Enum
+from collections import namedtuple
+from datetime import datetime
+
+units = {
+    # byte  : unit
+    0x1b : "W",
+    0x1e : "Wh",
+    0x20 : "varh",
+    0x21 : "A",
+    0x23 : "V",
+}
+
+class Type(Enum):
+    Date = 0
+    UInt16 = 1
+    UInt32 = 2
+    OctetString = 3
+
+valueTuples = [
+    # octetString,              , type,             name
+    (b'\x00\x00\x01\x00\x00\xFF', Type.Date,        "Datum"),
+    (b'\x00\x00\x60\x01\x00\xFF', Type.OctetString, "Zaehlernummer"),
+    (b'\x00\x00\x2A\x00\x00\xFF', Type.OctetString, "Logical Device Name"),
+    (b'\x01\x00\x01\x08\x00\xFF', Type.UInt32,      "Wirkenergie A+"), # Bezug
+    (b'\x01\x00\x02\x08\x00\xFF', Type.UInt32,      "Wirkenergie A-"), # Lieferung
+    (b'\x01\x00\x01\x07\x00\xFF', Type.UInt32,      "Wirkleistung P+"), # Bezug
+    (b'\x01\x00\x02\x07\x00\xFF', Type.UInt32,      "Wirkleistung P-"), # Lieferung
+    (b'\x01\x00\x03\x08\x00\xFF', Type.UInt32,      "Blindenergie Q+"), # Bezug
+    (b'\x01\x00\x04\x08\x00\xFF', Type.UInt32,      "Blindenergie Q-"), # Lieferung
+    (b'\x01\x00\x20\x07\x00\xFF', Type.UInt16,      "Spannung L1"),
+    (b'\x01\x00\x34\x07\x00\xFF', Type.UInt16,      "Spannung L2"),
+    (b'\x01\x00\x48\x07\x00\xFF', Type.UInt16,      "Spannung L3"),
+    (b'\x01\x00\x1F\x07\x00\xFF', Type.UInt16,      "Strom L1"),
+    (b'\x01\x00\x33\x07\x00\xFF', Type.UInt16,      "Strom L2"),
+    (b'\x01\x00\x47\x07\x00\xFF', Type.UInt16,      "Strom L3"),
+    (b'\x01\x00\x0D\x07\x00\xFF', Type.UInt16,      "Leistungsfaktor"),
+]
+
+# OBIS code as integer : (type, name)
+obisLookup = {int.from_bytes(value[0], byteorder='big'): (value[1], value[2]) for value in valueTuples}
+
+# decoded value of a known OBIS code
+Reading = namedtuple("Reading", ["name", "value", "unit"])
+
+class DecodeError(Exception):
+    """The plaintext is not a DataNotification that can be decoded"""
+
+# DLMS/COSEM A-XDR tags
+dlms_data_notification = 0x0F
+TAG_NULL = 0x00
+TAG_ARRAY = 0x01
+TAG_STRUCTURE = 0x02
+TAG_OCTET_STRING = 0x09
+TAG_VISIBLE_STRING = 0x0A
+TAG_INT8 = 0x0F
+TAG_ENUM = 0x16
+
+integer_tags = {
+    # tag : (size, signed)
+    0x03 : (1, False), # Boolean
+    0x05 : (4, True),  # Int32
+    0x06 : (4, False), # UInt32
+    0x0F : (1, True),  # Int8
+    0x10 : (2, True),  # Int16
+    0x11 : (1, False), # UInt8
+    0x12 : (2, False), # UInt16
+    0x14 : (8, True),  # Int64
+    0x15 : (8, False), # UInt64
+    0x16 : (1, False), # Enum
+}
+
+# values that are not decoded, skipped to reach the next value
+fixed_size_tags = {
+    # tag : size
+    0x0D : 1,  # BCD
+    0x17 : 4,  # Float32
+    0x18 : 8,  # Float64
+    0x19 : 12, # DateTime
+    0x1A : 5,  # Date
+    0x1B : 4,  # Time
+}
+TAG_BIT_STRING = 0x04
+TAG_UTF8_STRING = 0x0C
+
+# numeric values stored in the full resolution archive
+archive_fields = [value[2] for value in valueTuples if value[1] in (Type.UInt16, Type.UInt32)]
+
+def decrypt(data, key):
+    msglen1 = data[1] # 1. FA - 250 Byte
+
+    header1 = 27
+    header2 = 9
+
+    systitle = data[11:19] # System Title - 8 Bytes
+    framecounter = data[23:27] # Frame Counter - 4 Bytes
+    nonce = systitle + framecounter # iv ist 12 Bytes
+
+    # join both parts of the cyphertext from views of the frame, one copy
+    view = memoryview(data)
+    msg1 = view[header1:(6 + msglen1 - 2)]
+    msglen2 = data[msglen1 + 7]
+    msg2 = view[msglen1 + 6 + header2:(msglen1 + 5 + 5 + msglen2)]
+    cyphertext = b"".join((msg1, msg2))
+
+    # the authentication tag is not checked, so GCM decryption is plain
+    # CTR mode starting at counter 2 (counter 1 encrypts the tag).
+    # Setting up a CTR cipher is much cheaper than a GCM cipher.
+    cipher = AES.new(key, AES.MODE_CTR, nonce=nonce, initial_value=2)
+    return cipher.decrypt(cyphertext)
+
+def skipValue(data, pos):
+    """Position after a value that is not decoded, DecodeError for an unknown tag"""
+    tag = data[pos]
+    if tag in integer_tags:
+        return pos + 1 + integer_tags[tag][0]
+    if tag in fixed_size_tags:
+        return pos + 1 + fixed_size_tags[tag]
+    if tag == TAG_OCTET_STRING or tag == TAG_VISIBLE_STRING or tag == TAG_UTF8_STRING:
+        return pos + 2 + data[pos + 1]
+    if tag == TAG_BIT_STRING:
+        # length in bits
+        return pos + 2 + (data[pos + 1] + 7) // 8
+    if tag == TAG_NULL:
+        return pos + 1
+    raise DecodeError(f"Unknown DLMS tag 0x{tag:02X} at position {pos}")
+
+def walkDataNotification(plaintext, records):
+    """Decode the DataNotification into Reading records or the frame dict.
+
+    Walks the DataNotification tag by tag in a single pass and reads
+    from a memoryview of the plaintext, only strings are copied.
+    Structures are flattened, a known OBIS code is directly followed
+    by its value. Numeric values are followed by a structure with
+    their scaler (Int8) and unit (Enum). Values of unknown OBIS codes
+    or with an unexpected type are skipped.
+
+    With records a list of Reading records is returned, else the dict
+    of name : {"value", "unit"} is built directly, without records.
+    """
+    data = memoryview(plaintext)
+    end = len(data)
+    if end < 6 or data[0] != dlms_data_notification:
+        raise DecodeError("Invalid DataNotification")
+
+    # skip tag, long invoke id and optional date time of the notification
+    pos = 5
+    pos += 1 + data[pos]
+
+    # local names for the lookups in the loop
+    lookup = obisLookup
+    int_tags = integer_tags
+
+    decoded = [] if records else {}
+    try:
+        while pos < end:
+            tag = data[pos]
+
+            if tag == TAG_STRUCTURE or tag == TAG_ARRAY:
+                # skip element count, elements follow inline
+                pos += 2
+                continue
+
+            if tag != TAG_OCTET_STRING or data[pos + 1] != 6:
+                pos = skipValue(data, pos)
+                continue
+
+            # OBIS code, six bytes read as one integer
+            start = pos + 2
+            pos = start + 6
+            entry = lookup.get((data[start] << 40) | (data[start + 1] << 32) | (data[start + 2] << 24) |
+                               (data[start + 3] << 16) | (data[start + 4] << 8) | data[start + 5])
+            if entry is None:
+                continue
+
+            # read value of the OBIS code
+            tag = data[pos]
+            value_unit = None
+            if (tag == TAG_OCTET_STRING or tag == TAG_VISIBLE_STRING) and entry[0] is Type.Date:
+                start = pos + 2
+                pos = start + data[pos + 1]
+                value_converted = datetime(
+                    (data[start] << 8) | data[start + 1],
+                    data[start + 2],
+                    data[start + 3],
+                    data[start + 5],
+                    data[start + 6],
+                    data[start + 7])
+            elif tag == TAG_OCTET_STRING or tag == TAG_VISIBLE_STRING:
+                start = pos + 2
+                pos = start + data[pos + 1]
+                value_converted = str(data[start:pos], "ascii")
+            elif tag in int_tags:
+                size, signed = int_tags[tag]
+                start = pos + 1
+                pos = start + size
+                if size == 2:
+                    value_int = (data[start] << 8) | data[start + 1]
+                elif size == 4:
+                    value_int = (data[start] << 24) | (data[start + 1] << 16) | (data[start + 2] << 8) | data[start + 3]
+                else:
+                    value_int = data[start]
+                    for index in range(start + 1, pos):
+                        value_int = (value_int << 8) | data[index]
+                if signed and value_int >> (size * 8 - 1):
+                    value_int -= 1 << (size * 8)
+                # scaler and unit: 02 02 0F <scaler> 16 <unit>
+                value_scaling = 0
+                if pos + 6 <= end and data[pos] == TAG_STRUCTURE and data[pos + 2] == TAG_INT8 and data[pos + 4] == TAG_ENUM:
+                    value_scaling = data[pos + 3]
+                    if value_scaling > 127:
+                        value_scaling -= 256
+                    value_unit = units.get(data[pos + 5])
+                    pos += 6
+                value_converted = round(float(value_int) * pow(10.0, value_scaling), 2)
+            else:
+                # e.g. NULL for a value the meter does not measure
+                pos = skipValue(data, pos)
+                continue
+
+            if records:
+                decoded.append(Reading(entry[1], value_converted, value_unit))
+            elif value_unit is None:
+                decoded[entry[1]] = {"value": value_converted}
+            else:
+                decoded[entry[1]] = {"value": value_converted, "unit": value_unit}
+    except IndexError:
+        raise DecodeError("Truncated DataNotification") from None
+    except ValueError as e:
+        # e.g. a date time with fields out of range
+        raise DecodeError(f"Invalid value: {e}") from None
+
+    if pos > end:
+        raise DecodeError("Truncated DataNotification")
+    return decoded
+
+def decodeDataNotification(plaintext):
+    """List of the Reading records of the DataNotification"""
+    return walkDataNotification(plaintext, True)
+
+def getJsonCurrent(plaintext):
+    # the frame dict of the sinks, built without the records
+    return walkDataNotification(plaintext, False)
@@ -0,0 +1,201 @@
+#######################################
+#
+# encoder.py
+#
+# The reverse of dlms.py: builds encrypted frames as the meter sends
+# them, used by the benchmarks and to test the decoder without a meter.
+#
+# A frame is a DataNotification with one structure per value (OBIS
+# code, value and for numbers scaler and unit), encrypted with AES-GCM
+# and split into the two M-Bus long frames that decrypt() expects.
+#
+#######################################
+
+import random
+from datetime import datetime, timedelta
+
+from Crypto.Cipher import AES
+
+from .dlms import (TAG_ENUM, TAG_INT8, TAG_OCTET_STRING, TAG_STRUCTURE, Type, dlms_data_notification,
+                   valueTuples)
+from .framing import mbus_start_byte, mbus_stop_byte
+
+# name : (OBIS code, type)
+obis_codes = {value[2]: (value[0], value[1]) for value in valueTuples}
+
+integer_types = {
+    # type      : (tag, size)
+    Type.UInt16 : (0x12, 2),
+    Type.UInt32 : (0x06, 4),
+}
+
+field_units = {
+    # name            : unit byte
+    "Wirkenergie A+"  : 0x1e, # Wh
+    "Wirkenergie A-"  : 0x1e,
+    "Wirkleistung P+" : 0x1b, # W
+    "Wirkleistung P-" : 0x1b,
+    "Blindenergie Q+" : 0x20, # varh
+    "Blindenergie Q-" : 0x20,
+    "Spannung L1"     : 0x23, # V
+    "Spannung L2"     : 0x23,
+    "Spannung L3"     : 0x23,
+    "Strom L1"        : 0x21, # A
+    "Strom L2"        : 0x21,
+    "Strom L3"        : 0x21,
+    "Leistungsfaktor" : 0xff, # no unit
+}
+
+layouts = {
+    # name : [(field, scaler)], the order of the values in the frame
+    # as sent by the Kaifa meters of VKW (reference/capture_vkw.txt)
+    "vkw": [
+        ("Datum", None), ("Zaehlernummer", None), ("Logical Device Name", None),
+        ("Spannung L1", -1), ("Spannung L2", -1), ("Spannung L3", -1),
+        ("Strom L1", -2), ("Strom L2", -2), ("Strom L3", -2),
+        ("Wirkleistung P+", 0), ("Wirkleistung P-", 0),
+        ("Wirkenergie A+", 0), ("Wirkenergie A-", 0),
+        ("Blindenergie Q+", 0), ("Blindenergie Q-", 0),
+    ],
+    # every known value, with power factor
+    "full": [
+        ("Datum", None), ("Zaehlernummer", None), ("Logical Device Name", None),
+        ("Wirkenergie A+", 0), ("Wirkenergie A-", 0),
+        ("Wirkleistung P+", 0), ("Wirkleistung P-", 0),
+        ("Blindenergie Q+", 0), ("Blindenergie Q-", 0),
+        ("Spannung L1", -1), ("Spannung L2", -1), ("Spannung L3", -1),
+        ("Strom L1", -2), ("Strom L2", -2), ("Strom L3", -2),
+        ("Leistungsfaktor", -3),
+    ],
+    # energy counters only
+    "minimal": [
+        ("Datum", None), ("Zaehlernummer", None),
+        ("Wirkenergie A+", 0), ("Wirkenergie A-", 0),
+    ],
+}
+
+# M-Bus header fields of the segments
+mbus_control = 0x53
+mbus_address = 0xFF
+mbus_tsaps = b'\x01\x67'
+general_glo_ciphering = 0xDB
+security_control = 0x21
+# the first segment carries the ciphering header, the meter fills it to 250 bytes
+first_segment_header = 23
+segment_header = 5
+max_segment_length = 250
+
+def encodeDateTime(value):
+    # year, month, day, weekday, hour, minute, second, hundredths, deviation, clock status
+    return bytes((value.year >> 8, value.year & 0xFF, value.month, value.day, value.isoweekday(),
+                  value.hour, value.minute, value.second, 0x00, 0xFF, 0x88, 0x80))
+
+def encodeValue(name, value, scaler):
+    obis, value_type = obis_codes[name]
+    if value_type is Type.Date:
+        encoded = bytes((TAG_OCTET_STRING, 12)) + encodeDateTime(value)
+    elif value_type is Type.OctetString:
+        text = value.encode("ascii")
+        encoded = bytes((TAG_OCTET_STRING, len(text))) + text
+    else:
+        tag, size = integer_types[value_type]
+        raw = round(value / pow(10.0, scaler))
+        encoded = (bytes((tag,)) + raw.to_bytes(size, 'big') +
+                   bytes((TAG_STRUCTURE, 2, TAG_INT8, scaler & 0xFF, TAG_ENUM, field_units[name])))
+    return bytes((TAG_OCTET_STRING, 6)) + obis + encoded
+
+def encodeDataNotification(values, layout, invoke_id=0):
+    """Plaintext DataNotification of the values (name : value) in the order of the layout"""
+    timestamp = values["Datum"]
+    elements = []
+    count = 0
+    for name, scaler in layout:
+        if name not in values:
+            continue
+        element = encodeValue(name, values[name], scaler)
+        if name == "Datum":
+            # the meter sends the time as OBIS code and value directly in the outer structure
+            elements.append(element)
+            count += 2
+        else:
+            items = 3 if scaler is not None else 2
+            elements.append(bytes((TAG_STRUCTURE, items)) + element)
+            count += 1
+    return (bytes((dlms_data_notification,)) + invoke_id.to_bytes(4, 'big') +
+            bytes((12,)) + encodeDateTime(timestamp) +
+            bytes((TAG_STRUCTURE, count)) + b"".join(elements))
+
+def encrypt(plaintext, key, system_title, frame_counter):
+    """Ciphertext of AES-GCM, the authentication tag is not sent"""
+    cipher = AES.new(key, AES.MODE_GCM, nonce=system_title + frame_counter.to_bytes(4, 'big'))
+    return cipher.encrypt(plaintext)
+
+def longFrame(ci, user_data):
+    body = bytes((mbus_control, mbus_address, ci)) + user_data
+    return (bytes((mbus_start_byte, len(body), len(body), mbus_start_byte)) + body +
+            bytes((sum(body) & 0xFF, mbus_stop_byte)))
+
+def encodeFrame(values, key, layout=None, system_title=b'KFM\x10\x20\x02\xac\xa5', frame_counter=1, invoke_id=None):
+    """Encrypted frame of the values, as two M-Bus long frames"""
+    plaintext = encodeDataNotification(values, layouts["vkw"] if layout is None else layout,
+                                       frame_counter if invoke_id is None else invoke_id)
+    ciphertext = encrypt(plaintext, key, system_title, frame_counter)
+
+    split = min(max_segment_length - first_segment_header, len(ciphertext) - 1)
+    if len(ciphertext) - split > max_segment_length - segment_header:
+        raise Exception(f"DataNotification of {len(plaintext)} bytes does not fit into two segments")
+    apdu_length = 1 + 4 + len(ciphertext)
+    first = (mbus_tsaps + bytes((general_glo_ciphering, len(system_title))) + system_title +
+             bytes((0x82, apdu_length >> 8, apdu_length & 0xFF, security_control)) +
+             frame_counter.to_bytes(4, 'big') + ciphertext[:split])
+    second = mbus_tsaps + ciphertext[split:]
+    return longFrame(0x00, first) + longFrame(0x11, second)
+
+#######################################
+# Random frames
+
+def randomValues(rng, layout, timestamp, meter_number="1KFM0200175269", counters=None, interval_seconds=5):
+    """Plausible random values for the fields of a layout.
+
+    The energy counters are taken from counters (name : value) and
+    advanced by the energy of a random power over interval_seconds, so
+    they never decrease when counters is carried across frames.
+    """
+    if counters is None:
+        counters = {}
+    values = {"Datum": timestamp, "Zaehlernummer": meter_number, "Logical Device Name": "KFM1200" + meter_number[-9:]}
+    ranges = {
+        "Wirkleistung P+": (0, 12000), "Wirkleistung P-": (0, 8000),
+        "Spannung L1": (215, 245), "Spannung L2": (215, 245), "Spannung L3": (215, 245),
+        "Strom L1": (0, 40), "Strom L2": (0, 40), "Strom L3": (0, 40),
+        "Leistungsfaktor": (0.5, 1),
+    }
+    for name, scaler in layout:
+        if scaler is None:
+            continue
+        if name in ranges:
+            low, high = ranges[name]
+            value = rng.uniform(low, high)
+        else:
+            # counters start in the range of a meter after some years
+            start, power = (1000000, 12000) if name.endswith("+") else (500000, 8000)
+            value = counters.get(name, start + rng.randrange(0, 5000)) + rng.uniform(0, power) * interval_seconds / 3600
+            counters[name] = value
+        # values on the grid of the scaler, like the meter
+        values[name] = round(value / pow(10.0, scaler)) * pow(10.0, scaler)
+    names = {name for name, scaler in layout}
+    return {name: value for name, value in values.items() if name in names}
+
+def randomFrames(key, layout_name="vkw", count=1000, seed=0, start=None, interval_seconds=5):
+    """Encrypted frames with random values, meter time advancing by interval_seconds"""
+    rng = random.Random(seed)
+    layout = layouts[layout_name]
+    timestamp = start or datetime(2024, 1, 1)
+    # energy counters carried across the frames
+    counters = {}
+    frames = []
+    for frame_counter in range(1, count + 1):
+        values = randomValues(rng, layout, timestamp, counters=counters, interval_seconds=interval_seconds)
+        frames.append(encodeFrame(values, key, layout, frame_counter=frame_counter))
+        timestamp += timedelta(seconds=interval_seconds)
+    return frames
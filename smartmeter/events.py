@@ -0,0 +1,194 @@
+#######################################
+#
+# events.py
+#
+# Change detection and threshold events on the decoded values.
+#
+# ChangeFilter decides whether a frame differs enough from the last
+# written one to be worth a write, using a deadband per field.
+#
+# EventEngine evaluates the rules of config.event_rules on every frame.
+# A rule matches once its condition held for the configured number of
+# seconds (meter time) and ends with the first frame without it. Every
+# match is a row in the events table with start and end timestamp. Only
+# the state of the current frame is kept, so a frame costs the same no
+# matter how long an event lasts, and rows are only written when an
+# event starts or ends.
+#
+#######################################
+
+from .metrics import metrics
+
+#######################################
+# Change filter
+
+class ChangeFilter:
+    """Per meter deadband filter, fields without a deadband must be equal"""
+
+    def __init__(self, deadbands, max_age_seconds):
+        self.deadbands = deadbands
+        self.max_age_seconds = max_age_seconds
+        # meter number : (timestamp, {name: value}) of the last accepted frame
+        self.accepted = {}
+
+    def changed(self, json_current):
+        """True if the frame should be written, it then becomes the reference"""
+        meter_number = json_current.get("Zaehlernummer", {}).get("value")
+        timestamp = json_current["Datum"]["value"]
+        reference = self.accepted.get(meter_number)
+        if reference is not None and (timestamp - reference[0]).total_seconds() < self.max_age_seconds:
+            values = reference[1]
+            deadbands = self.deadbands
+            for name, entry in json_current.items():
+                if name == "Datum":
+                    continue
+                value = entry.get("value")
+                previous = values.get(name)
+                if value == previous:
+                    continue
+                deadband = deadbands.get(name)
+                if deadband is None or value is None or previous is None or abs(value - previous) > deadband:
+                    break
+            else:
+                return False
+
+        self.accepted[meter_number] = (timestamp, {name: entry.get("value") for name, entry in json_current.items()})
+        return True
+
+    def reset(self):
+        self.accepted = {}
+
+#######################################
+# Rules
+
+def values(json_current, fields):
+    result = []
+    for name in fields:
+        value = json_current.get(name, {}).get("value")
+        if value is None:
+            return None
+        result.append(value)
+    return result
+
+def conditionAbove(json_current, fields, limit):
+    """Largest of the fields if it exceeds limit"""
+    current = values(json_current, fields)
+    if current is None or max(current) <= limit:
+        return None
+    return max(current)
+
+def conditionBelow(json_current, fields, limit):
+    """Smallest of the fields if it is below limit"""
+    current = values(json_current, fields)
+    if current is None or min(current) >= limit:
+        return None
+    return min(current)
+
+def conditionDeviation(json_current, fields, limit, nominal):
+    """Largest relative deviation from nominal if it exceeds limit"""
+    current = values(json_current, fields)
+    if current is None:
+        return None
+    deviation = max(abs(value - nominal) / nominal for value in current)
+    return deviation if deviation > limit else None
+
+def conditionImbalance(json_current, fields, limit, minimum):
+    """(max - min) / mean of the fields if it exceeds limit, ignored while the mean is below minimum"""
+    current = values(json_current, fields)
+    if current is None:
+        return None
+    mean = sum(current) / len(current)
+    if mean < minimum:
+        return None
+    imbalance = (max(current) - min(current)) / mean
+    return imbalance if imbalance > limit else None
+
+conditions = {
+    "above": conditionAbove,
+    "below": conditionBelow,
+    "deviation": conditionDeviation,
+    "imbalance": conditionImbalance,
+}
+
+class RuleState:
+    """State of one rule for one meter"""
+
+    def __init__(self):
+        self.pending_since = None
+        self.event_id = None
+        self.peak = None
+
+#######################################
+# Event engine
+
+sql_open_event = '''
+    INSERT INTO events (meter_number, rule, start_timestamp, peak_value)
+    VALUES (?, ?, ?, ?)
+'''
+sql_close_event = 'UPDATE events SET end_timestamp = ?, peak_value = ? WHERE id = ?'
+# events left open by a crash end with the last history entry of their meter
+sql_close_interrupted = '''
+    UPDATE events SET end_timestamp = coalesce(
+        (SELECT max(timestamp) FROM history WHERE history.meter_number IS events.meter_number),
+        start_timestamp)
+    WHERE end_timestamp IS NULL
+'''
+
+class EventEngine:
+    """Sink evaluating the event rules, writes through the connection of a DatabaseWriter"""
+
+    def __init__(self, writer, rules):
+        self.writer = writer
+        # (name, condition function, fields, parameters, seconds)
+        self.rules = []
+        for name, condition, fields, parameters, seconds in rules:
+            if condition not in conditions:
+                raise Exception(f"Unknown condition {condition} of event rule {name}")
+            self.rules.append((name, conditions[condition], fields, parameters, seconds))
+        # (meter number, rule name) : RuleState
+        self.states = {}
+        # meter number : timestamp of the last frame
+        self.last_timestamps = {}
+        # autocommit, events are rare
+        self.cursor = writer.conn.cursor()
+        self.cursor.execute(sql_close_interrupted)
+
+    def write(self, json_current):
+        meter_number = json_current.get("Zaehlernummer", {}).get("value")
+        timestamp = json_current["Datum"]["value"]
+        self.last_timestamps[meter_number] = timestamp
+        for name, condition, fields, parameters, seconds in self.rules:
+            state = self.states.get((meter_number, name))
+            if state is None:
+                state = self.states[(meter_number, name)] = RuleState()
+
+            value = condition(json_current, fields, *parameters)
+            if value is None:
+                if state.event_id is not None:
+                    self.closeEvent(state, timestamp)
+                state.pending_since = None
+                continue
+
+            if state.event_id is not None:
+                state.peak = max(state.peak, value)
+                continue
+            if state.pending_since is None:
+                state.pending_since = timestamp
+                state.peak = value
+            else:
+                state.peak = max(state.peak, value)
+            if (timestamp - state.pending_since).total_seconds() >= seconds:
+                self.cursor.execute(sql_open_event, (meter_number, name, state.pending_since, state.peak))
+                state.event_id = self.cursor.lastrowid
+                metrics.increment("events")
+
+    def closeEvent(self, state, timestamp):
+        self.cursor.execute(sql_close_event, (timestamp, state.peak, state.event_id))
+        state.event_id = None
+        state.peak = None
+
+    def close(self):
+        # events still active end with the last frame
+        for (meter_number, name), state in self.states.items():
+            if state.event_id is not None:
+                self.closeEvent(state, self.last_timestamps[meter_number])
@@ -0,0 +1,198 @@
+#######################################
+#
+# exporter.py
+#
+# Forwards the decoded frames to a time-series database in the InfluxDB
+# line protocol (InfluxDB /api/v2/write, VictoriaMetrics /write, ...).
+#
+# The sink only formats the line and puts it into a bounded queue, a
+# background thread sends the lines in batches, flushed by size or time.
+# When the queue is full the oldest line is dropped, the readout never
+# waits for the network. Batches that cannot be sent are appended to a
+# spool file, which is replayed in order once the target is reachable.
+#
+#######################################
+
+import gzip
+import itertools
+import os
+import queue
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from . import config
+from .database import field_columns
+from .metrics import metrics
+
+# retry delays after a failed request in seconds
+retry_min_seconds = 5
+retry_max_seconds = 300
+
+def escapeTag(value):
+    return str(value).replace("\\", "\\\\").replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+def formatLine(json_current, measurement="smartmeter"):
+    """One frame as line protocol with a timestamp in seconds, None if it has no values"""
+    fields = []
+    for name, column in field_columns:
+        value = json_current.get(name, {}).get("value")
+        if value is not None:
+            fields.append(f"{column}={float(value)!r}")
+    if not fields:
+        return None
+    meter_number = json_current.get("Zaehlernummer", {}).get("value") or "unknown"
+    timestamp = int(json_current["Datum"]["value"].timestamp())
+    return f"{measurement},meter={escapeTag(meter_number)} {','.join(fields)} {timestamp}\n".encode("utf-8")
+
+class LineProtocolExporter:
+    """Sink sending frames in batches from a background thread"""
+
+    def __init__(self, url, token=None, batch_size=None, flush_seconds=None, queue_size=None,
+                 spool_file=None, spool_max_bytes=None):
+        self.url = url
+        self.token = token
+        self.batch_size = batch_size or config.export_batch_size
+        self.flush_seconds = flush_seconds or config.export_flush_seconds
+        self.spool_file = spool_file or config.export_spool_file
+        self.spool_max_bytes = spool_max_bytes or config.export_spool_max_bytes
+        self.queue = queue.Queue(maxsize=queue_size or config.export_queue_size)
+        self.retry_at = 0.0
+        self.retry_delay = retry_min_seconds
+        self.thread = threading.Thread(target=self.run, name="exporter", daemon=True)
+        self.thread.start()
+
+    def write(self, json_current):
+        line = formatLine(json_current)
+        if line is None:
+            return
+        try:
+            self.queue.put_nowait(line)
+        except queue.Full:
+            # sender is stuck, keep the newest lines
+            try:
+                self.queue.get_nowait()
+                metrics.increment("export_dropped_lines")
+            except queue.Empty:
+                pass
+            self.queue.put_nowait(line)
+
+    def close(self, timeout=10):
+        # None tells the sender to flush and stop
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.thread.join(timeout)
+
+    def run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = self.flush_seconds if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                line = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                line = False
+            metrics.set("export_queue_depth", self.queue.qsize())
+
+            if line is None:
+                if batch:
+                    self.flush(batch)
+                return
+            if line:
+                batch.append(line)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_seconds
+            if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                self.flush(batch)
+                batch = []
+                deadline = None
+            elif not batch and os.path.exists(self.spool_file) and time.monotonic() >= self.retry_at:
+                # idle, try to deliver the spool
+                self.replaySpool()
+
+    def flush(self, batch):
+        payload = b"".join(batch)
+        # older spooled lines go first, a new batch waits behind them
+        if os.path.exists(self.spool_file):
+            if time.monotonic() < self.retry_at or not self.replaySpool():
+                self.spool(payload, len(batch))
+                return
+        if not self.post(payload, len(batch)):
+            self.spool(payload, len(batch))
+
+    def post(self, payload, lines):
+        """Send a payload, False if it should be retried later"""
+        headers = {"Content-Type": "text/plain; charset=utf-8", "Content-Encoding": "gzip"}
+        if self.token:
+            headers["Authorization"] = f"Token {self.token}"
+        request = urllib.request.Request(self.url, data=gzip.compress(payload), headers=headers, method="POST")
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=config.export_timeout_seconds) as response:
+                response.read()
+        except urllib.error.HTTPError as e:
+            if 400 <= e.code < 500 and e.code != 429:
+                # the target will never accept these lines, retrying would block the spool
+                print(f"Export rejected by {self.url}: {e.code} {e.reason}")
+                metrics.increment("export_rejected_lines", lines)
+                return True
+            return self.failed(e)
+        except (urllib.error.URLError, OSError) as e:
+            return self.failed(e)
+        metrics.observe("export", time.perf_counter() - started)
+        metrics.increment("export_sent_lines", lines)
+        self.retry_delay = retry_min_seconds
+        return True
+
+    def failed(self, error):
+        if self.retry_delay == retry_min_seconds:
+            # print once per outage
+            print(f"Export to {self.url} failed, spooling: {error}")
+        metrics.increment("export_failures")
+        self.retry_at = time.monotonic() + self.retry_delay
+        self.retry_delay = min(self.retry_delay * 2, retry_max_seconds)
+        return False
+
+    def spool(self, payload, lines):
+        try:
+            size = os.path.getsize(self.spool_file) if os.path.exists(self.spool_file) else 0
+            if size + len(payload) > self.spool_max_bytes:
+                metrics.increment("export_dropped_lines", lines)
+                return
+            with open(self.spool_file, "ab") as spool_file:
+                spool_file.write(payload)
+            metrics.increment("export_spooled_lines", lines)
+        except OSError as e:
+            metrics.increment("export_dropped_lines", lines)
+            print(f"Error writing export spool: {e}")
+
+    def replaySpool(self):
+        """Send the spool in batches, True once it is empty"""
+        with open(self.spool_file, "rb") as spool_file:
+            while True:
+                offset = spool_file.tell()
+                batch = list(itertools.islice(spool_file, self.batch_size))
+                if not batch:
+                    break
+                if not self.post(b"".join(batch), len(batch)):
+                    self.keepSpool(spool_file, offset)
+                    return False
+        os.remove(self.spool_file)
+        print(f"Export to {self.url} recovered, spool delivered")
+        return True
+
+    def keepSpool(self, spool_file, offset):
+        # drop the delivered part of the spool
+        if offset == 0:
+            return
+        spool_file.seek(offset)
+        with open(self.spool_file + ".tmp", "wb") as remaining:
+            while True:
+                chunk = spool_file.read(65536)
+                if not chunk:
+                    break
+                remaining.write(chunk)
+        os.replace(self.spool_file + ".tmp", self.spool_file)
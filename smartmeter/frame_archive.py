@@ -0,0 +1,107 @@
+#######################################
+#
+# frame_archive.py
+#
+# Archive of the raw encrypted frames as received from the meter, so
+# values can be decoded again after parser or schema changes.
+#
+# Frames are appended to gzip compressed segment files, one per day.
+# Every record is length prefixed:
+#   uint16 frame length, float64 receive time (unix), frame bytes
+# The stream is flushed regularly, so a segment that was not closed
+# properly can be read up to the last flush.
+#
+#######################################
+
+from datetime import datetime, timedelta
+import os
+import struct
+import time
+import zlib
+
+record_header = struct.Struct("<Hd")
+segment_suffix = ".frames.gz"
+
+class FrameArchive:
+    """Appends raw frames to rotating compressed segment files"""
+
+    def __init__(self, directory, keep_days=365, flush_seconds=60):
+        self.directory = directory
+        self.keep_days = keep_days
+        self.flush_seconds = flush_seconds
+        self.segment_file = None
+        self.compressor = None
+        self.day = None
+        self.last_flush = 0.0
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, data, received=None):
+        if received is None:
+            received = time.time()
+        day = datetime.fromtimestamp(received).date()
+        if day != self.day:
+            self.rotate(day)
+
+        # the compressor reads the frame through the buffer protocol, no copy
+        self.segment_file.write(self.compressor.compress(record_header.pack(len(data), received)))
+        self.segment_file.write(self.compressor.compress(memoryview(data)))
+
+        if received - self.last_flush >= self.flush_seconds:
+            self.segment_file.write(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+            self.segment_file.flush()
+            self.last_flush = received
+
+    def rotate(self, day):
+        self.closeSegment()
+        self.day = day
+        # a new file per start, appending to a finished gzip stream is not readable
+        name = f"{day.isoformat()}-{datetime.now().strftime('%H%M%S')}{segment_suffix}"
+        self.segment_file = open(os.path.join(self.directory, name), "wb")
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        self.removeOldSegments(day)
+
+    def removeOldSegments(self, day):
+        threshold = (day - timedelta(days=self.keep_days)).isoformat()
+        for name in os.listdir(self.directory):
+            if name.endswith(segment_suffix) and name[:10] < threshold:
+                os.remove(os.path.join(self.directory, name))
+
+    def closeSegment(self):
+        if self.segment_file is not None:
+            self.segment_file.write(self.compressor.flush())
+            self.segment_file.close()
+            self.segment_file = None
+
+    def close(self):
+        self.closeSegment()
+
+def listSegments(directory):
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(segment_suffix))
+
+def readSegment(path, chunk_size=65536):
+    """Yield (receive time, frame) of a segment, stops at a truncated record"""
+    decompressor = zlib.decompressobj(31)
+    buffer = bytearray()
+    pos = 0
+    with open(path, "rb") as segment_file:
+        while True:
+            chunk = segment_file.read(chunk_size)
+            if chunk:
+                buffer += decompressor.decompress(chunk)
+            # yield all complete records
+            while len(buffer) - pos >= record_header.size:
+                length, received = record_header.unpack_from(buffer, pos)
+                end = pos + record_header.size + length
+                if end > len(buffer):
+                    break
+                yield received, bytes(buffer[pos + record_header.size:end])
+                pos = end
+            del buffer[:pos]
+            pos = 0
+            if not chunk or decompressor.eof:
+                return
+
+def readFrames(directory):
+    """Yield (receive time, frame) of all segments in order"""
+    for path in listSegments(directory):
+        yield from readSegment(path)
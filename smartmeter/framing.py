@@ -0,0 +1,105 @@
+#######################################
+#
+# framing.py
+#
+# Splits the byte stream of the meter into M-Bus long frames and joins
+# the segments of a message.
+#
+#######################################
+
+from collections import deque
+import time
+
+from .metrics import metrics
+
+mbus_start_byte = 0x68
+mbus_stop_byte = 0x16
+
+class MbusFramer:
+    """Incremental framer for the M-Bus long frames sent by the meter.
+
+    Received bytes are appended to a rolling buffer which is scanned for
+    the start sequence 68 L L 68. A long frame is accepted once its stop
+    byte arrived and its checksum matches. The meter splits a message
+    into several long frames, the segments are joined and the message is
+    queued as soon as its last segment is complete.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.segments = []
+        self.frames = deque()
+        self.rejected_frames = 0
+        self.discarded_bytes = 0
+
+    def feed(self, data):
+        buffer = self.buffer
+        buffer += data
+        pos = 0
+        discarded = 0
+        with memoryview(buffer) as view:
+            while True:
+                start = buffer.find(mbus_start_byte, pos)
+                if start == -1:
+                    discarded += len(buffer) - pos
+                    pos = len(buffer)
+                    break
+                discarded += start - pos
+                pos = start
+
+                # wait for the complete header
+                if len(buffer) - start < 4:
+                    break
+                length = buffer[start + 1]
+                if buffer[start + 2] != length or buffer[start + 3] != mbus_start_byte:
+                    pos = start + 1
+                    continue
+
+                # wait for the complete frame
+                end = start + length + 6
+                if len(buffer) < end:
+                    break
+
+                # check stop byte and checksum over C field to last user data byte
+                if buffer[end - 1] != mbus_stop_byte or (sum(view[start + 4:end - 2]) & 0xFF) != buffer[end - 2]:
+                    self.rejected_frames += 1
+                    metrics.increment("rejected_frames")
+                    pos = start + 1
+                    continue
+
+                self.addSegment(bytes(view[start:end]))
+                pos = end
+        del buffer[:pos]
+        if discarded:
+            # bytes outside of frames, the framer had to resynchronize
+            self.discarded_bytes += discarded
+            metrics.increment("resyncs")
+            metrics.increment("discarded_bytes", discarded)
+
+    def addSegment(self, segment):
+        # the control information field holds the segment number,
+        # the last segment is marked by 0x10
+        ci = segment[6]
+        if ci & 0x0F == 0:
+            self.segments = []
+        elif len(self.segments) != ci & 0x0F:
+            # a previous segment is missing
+            self.segments = []
+            self.rejected_frames += 1
+            metrics.increment("rejected_frames")
+            return
+        self.segments.append(segment)
+        if ci & 0x10:
+            self.frames.append(b"".join(self.segments))
+            self.segments = []
+
+def readPacket(transport, framer):
+    # read whatever is available, block for at least one byte
+    while not framer.frames:
+        started = time.perf_counter()
+        data = transport.read()
+        received = time.perf_counter()
+        framer.feed(data)
+        metrics.observe("serial_wait", received - started)
+        metrics.observe("framing", time.perf_counter() - received)
+    return framer.frames.popleft()
@@ -0,0 +1,338 @@
+#######################################
+#
+# http_api.py
+#
+# Optional HTTP server inside the readout process.
+#
+#   /current                      latest decoded frame, from memory
+#   /current?after=<timestamp>    waits until a frame newer than timestamp arrives
+#   /history?hours=<h>            history from the database, cached until the
+#                                 next history entry, with ETag/If-None-Match
+#   /events                       every frame as Server-Sent Events
+#   /ws                           every frame as WebSocket text messages
+#   /metrics                      stage latencies and counters, Prometheus text format
+#
+# All endpoints take an optional meter=<meter number>, without it the
+# meter of the latest frame is used.
+#
+#######################################
+
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import base64
+import hashlib
+import json
+import queue
+import threading
+import time
+
+from .metrics import metrics
+
+long_poll_timeout = 30
+keepalive_interval = 15
+subscriber_queue_size = 4
+# a subscriber that had to skip frames this often without catching up is dropped
+subscriber_max_skips = 20
+# longest history served, one year
+max_history_hours = 24 * 366
+# serialized history responses kept for one history generation
+history_cache_size = 16
+websocket_guid = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# one frame, serialized for every kind of subscriber
+Message = namedtuple("Message", ["meter_number", "sse", "websocket"])
+
+def encodeWebSocketFrame(payload, opcode=0x1):
+    # final frame, server frames are not masked
+    length = len(payload)
+    if length < 126:
+        header = bytes([0x80 | opcode, length])
+    elif length < 65536:
+        header = bytes([0x80 | opcode, 126]) + length.to_bytes(2, byteorder='big')
+    else:
+        header = bytes([0x80 | opcode, 127]) + length.to_bytes(8, byteorder='big')
+    return header + payload
+
+class Subscriber:
+    """Bounded queue of one subscriber, skips to the latest frame when full"""
+
+    def __init__(self, meter_number):
+        self.meter_number = meter_number
+        self.queue = queue.Queue(maxsize=subscriber_queue_size)
+        self.skipped = 0
+        self.dropped = False
+
+    def put(self, message):
+        try:
+            self.queue.put_nowait(message)
+            return
+        except queue.Full:
+            pass
+
+        # slow subscriber, discard the queued frames and keep the latest
+        self.skipped += 1
+        try:
+            while True:
+                self.queue.get_nowait()
+        except queue.Empty:
+            pass
+        if self.skipped >= subscriber_max_skips:
+            self.dropped = True
+            message = None
+        self.queue.put_nowait(message)
+
+    def get(self, timeout):
+        """Next message, None when the subscriber was dropped, raises queue.Empty on timeout"""
+        message = self.queue.get(timeout=timeout)
+        if self.queue.empty():
+            # caught up
+            self.skipped = 0
+        return message
+
+class FrameHub:
+    """Fans out every frame to all subscribers without blocking the readout"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = set()
+
+    def subscribe(self, meter_number=None):
+        subscriber = Subscriber(meter_number)
+        with self.lock:
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def publish(self, meter_number, body):
+        with self.lock:
+            if not self.subscribers:
+                return
+            subscribers = list(self.subscribers)
+        message = Message(meter_number,
+                          b"event: frame\ndata: " + body + b"\n\n",
+                          encodeWebSocketFrame(body))
+        for subscriber in subscribers:
+            if subscriber.meter_number is None or subscriber.meter_number == meter_number:
+                subscriber.put(message)
+
+class LatestReading:
+    """Sink keeping the latest decoded frame of every meter in memory"""
+
+    def __init__(self, hub=None):
+        self.condition = threading.Condition()
+        # meter number : (timestamp, serialized frame)
+        self.frames = {}
+        self.latest_meter = None
+        self.hub = hub
+
+    def write(self, json_current):
+        # serialized once per frame, requests only copy the bytes
+        body = json.dumps(json_current, default=str).encode("utf-8")
+        timestamp = str(json_current["Datum"]["value"])
+        meter_number = json_current.get("Zaehlernummer", {}).get("value")
+        with self.condition:
+            self.frames[meter_number] = (timestamp, body)
+            self.latest_meter = meter_number
+            self.condition.notify_all()
+        if self.hub is not None:
+            self.hub.publish(meter_number, body)
+
+    def get(self, meter_number=None, after=None, timeout=long_poll_timeout):
+        """Return (timestamp, body) of the latest frame, None if no newer frame arrived in time"""
+        def newer():
+            frame = self.frames.get(self.latest_meter if meter_number is None else meter_number)
+            if frame is not None and (after is None or frame[0] > after):
+                return frame
+            return None
+
+        with self.condition:
+            return self.condition.wait_for(newer, timeout=timeout)
+
+    def close(self):
+        pass
+
+class HistoryCache:
+    """Serialized history responses, valid until the writer adds a history entry"""
+
+    def __init__(self, writer, history_loader):
+        self.writer = writer
+        self.history_loader = history_loader
+        self.lock = threading.Lock()
+        self.entries = {}
+        # history_changes the entries belong to
+        self.changes = -1
+        # distinguishes ETags of different process runs
+        self.instance = f"{int(time.time()):x}"
+
+    def etag(self, hours, meter_number, changes):
+        return f'"{self.instance}-{changes}-{meter_number}-{hours}"'
+
+    def get(self, hours, meter_number, if_none_match=None):
+        """Return (etag, body), body is None if if_none_match is the current ETag"""
+        # one read of the counter for the ETag and the cache, a history entry
+        # written in between must not give an older body a newer ETag
+        changes = self.writer.history_changes
+        etag = self.etag(hours, meter_number, changes)
+        if if_none_match == etag:
+            return (etag, None)
+        with self.lock:
+            if changes > self.changes:
+                # entries of older history are never valid again
+                self.entries.clear()
+                self.changes = changes
+            entry = self.entries.get((hours, meter_number))
+        if entry is not None and entry[0] == etag:
+            return entry
+
+        body = json.dumps(self.history_loader(hours, meter_number), default=str).encode("utf-8")
+        with self.lock:
+            if changes == self.changes:
+                # the keys come from the client, the oldest entry makes room
+                if len(self.entries) >= history_cache_size:
+                    del self.entries[next(iter(self.entries))]
+                self.entries[(hours, meter_number)] = (etag, body)
+        return (etag, body)
+
+class ApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        meter_number = query.get("meter", [None])[0]
+
+        if url.path == "/current":
+            after = query.get("after", [None])[0]
+            if after is not None:
+                after = after.replace("T", " ")
+                frame = self.server.latest.get(meter_number, after)
+            else:
+                frame = self.server.latest.get(meter_number, timeout=0)
+            if frame is None:
+                self.sendBody(204 if after is not None else 404, b"")
+                return
+            self.sendBody(200, frame[1])
+
+        elif url.path == "/history":
+            try:
+                hours = float(query.get("hours", ["24"])[0])
+            except ValueError:
+                hours = None
+            if hours is None or not 0 < hours <= max_history_hours:
+                self.sendBody(400, b'{"error": "invalid hours"}')
+                return
+            # 24, 24.0 and 2.4e1 share one cache entry
+            hours = int(hours) if hours.is_integer() else hours
+            if meter_number is None:
+                meter_number = self.server.latest.latest_meter
+            etag, body = self.server.history.get(hours, meter_number, self.headers.get("If-None-Match"))
+            if body is None:
+                self.sendBody(304, b"", etag)
+                return
+            self.sendBody(200, body, etag)
+
+        elif url.path == "/events":
+            self.serveEvents(meter_number)
+
+        elif url.path == "/ws":
+            self.serveWebSocket(meter_number)
+
+        elif url.path == "/metrics":
+            self.sendBody(200, metrics.render().encode("utf-8"), content_type="text/plain; version=0.0.4")
+
+        else:
+            self.sendBody(404, b'{"error": "not found"}')
+
+    def serveEvents(self, meter_number):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        self.streamMessages(meter_number, lambda message: message.sse, b": keepalive\n\n")
+
+    def serveWebSocket(self, meter_number):
+        key = self.headers.get("Sec-WebSocket-Key")
+        if key is None or self.headers.get("Upgrade", "").lower() != "websocket":
+            self.sendBody(400, b'{"error": "websocket upgrade expected"}')
+            return
+        accept = base64.b64encode(hashlib.sha1((key + websocket_guid).encode("ascii")).digest())
+        self.send_response(101)
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept.decode("ascii"))
+        self.end_headers()
+        self.close_connection = True
+        # messages of the client are not read, a ping keeps the connection alive
+        self.streamMessages(meter_number, lambda message: message.websocket, encodeWebSocketFrame(b"", 0x9))
+
+    def streamMessages(self, meter_number, select, keepalive):
+        hub = self.server.hub
+        subscriber = hub.subscribe(meter_number)
+        try:
+            while True:
+                try:
+                    message = subscriber.get(keepalive_interval)
+                except queue.Empty:
+                    self.wfile.write(keepalive)
+                    continue
+                if message is None:
+                    # dropped as too slow
+                    break
+                self.wfile.write(select(message))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            hub.unsubscribe(subscriber)
+
+    def sendBody(self, status, body, etag=None, content_type="application/json"):
+        self.send_response(status)
+        if etag is not None:
+            self.send_header("ETag", etag)
+        if status != 304:
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body and status != 304:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # no logging per request
+        pass
+
+def startApiServer(port, latest, writer, history_loader, host=""):
+    """Serve the API from a background thread, returns the server"""
+    server = ThreadingHTTPServer((host, port), ApiHandler)
+    server.daemon_threads = True
+    server.hub = latest.hub if latest.hub is not None else FrameHub()
+    server.latest = latest
+    server.history = HistoryCache(writer, history_loader)
+    threading.Thread(target=server.serve_forever, name="http", daemon=True).start()
+    return server
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def startMetricsServer(port, host="127.0.0.1"):
+    """Serve /metrics from a background thread"""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
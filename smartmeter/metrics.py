@@ -0,0 +1,101 @@
+#######################################
+#
+# metrics.py
+#
+# Low overhead instrumentation of the readout: latency histograms per
+# stage and event counters, rendered in the Prometheus text format.
+# They can be served on a local port (see http_api.startMetricsServer)
+# and/or written to a stats file, e.g. for the node_exporter textfile
+# collector.
+#
+#######################################
+
+from bisect import bisect_left
+import os
+import time
+
+# upper bounds of the histogram buckets in seconds
+histogram_buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                     0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+metric_prefix = "smartmeter_"
+
+class Histogram:
+    def __init__(self):
+        # last bucket is +Inf
+        self.counts = [0] * (len(histogram_buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(histogram_buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+class Metrics:
+    """Registry of stage histograms and counters.
+
+    Updates are plain integer and float operations without locking, a
+    rendered snapshot may be off by the update that runs concurrently.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+        self.started = time.time()
+
+    def observe(self, stage, seconds):
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages.setdefault(stage, Histogram())
+        histogram.observe(seconds)
+
+    def increment(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        self.gauges[name] = value
+
+    def render(self):
+        lines = []
+        name = f"{metric_prefix}stage_duration_seconds"
+        lines.append(f"# HELP {name} Duration of the readout stages")
+        lines.append(f"# TYPE {name} histogram")
+        for stage, histogram in sorted(self.stages.items()):
+            cumulative = 0
+            for bound, count in zip(histogram_buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.sum}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+
+        for counter, value in sorted(self.counters.items()):
+            lines.append(f"# TYPE {metric_prefix}{counter}_total counter")
+            lines.append(f"{metric_prefix}{counter}_total {value}")
+
+        for gauge, value in sorted(self.gauges.items()):
+            lines.append(f"# TYPE {metric_prefix}{gauge} gauge")
+            lines.append(f"{metric_prefix}{gauge} {value}")
+
+        lines.append(f"# TYPE {metric_prefix}start_time_seconds gauge")
+        lines.append(f"{metric_prefix}start_time_seconds {self.started}")
+        return "\n".join(lines) + "\n"
+
+# registry of the process
+metrics = Metrics()
+
+def writeMetricsFile(path):
+    # written next to the target and renamed, readers never see a partial file
+    with open(path + ".tmp", "w") as metrics_file:
+        metrics_file.write(metrics.render())
+    os.replace(path + ".tmp", path)
+
+def metricsFileLoop(path, interval=60):
+    while True:
+        time.sleep(interval)
+        try:
+            writeMetricsFile(path)
+        except Exception as e:
+            print(f"Error writing metrics file: {e}")
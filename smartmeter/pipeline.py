@@ -0,0 +1,175 @@
+#######################################
+#
+# pipeline.py
+#
+# Readout stages on separate threads, connected by bounded queues:
+#
+#   reader  : serial port -> framer -> frame queue  (caller's thread)
+#   decoder : frame queue -> frame archive, decrypt, decode -> decoded queue
+#   writer  : decoded queue -> sinks
+#
+# The reader only frames bytes and enqueues, so the serial port is
+# serviced while the database or the backup stalls the writer. When a
+# queue is full the oldest entry is dropped. A writer that fell behind
+# takes the whole backlog at once and passes it to sinks that have a
+# writeBatch() method (DatabaseWriter: one transaction, one current row).
+# Queue depths, drops and coalesced frames are exported as metrics.
+#
+#######################################
+
+import queue
+import threading
+import time
+
+from . import config
+from .dlms import DecodeError, decrypt, getJsonCurrent
+from .metrics import metrics
+
+def decodeFrame(data, key, frame_archive=None, received=None):
+    """Decrypt and decode one frame, None if it could not be decoded"""
+    metrics.increment("frames")
+    if frame_archive is not None:
+        try:
+            # the time of reception, the decoder may run behind
+            frame_archive.write(data, received)
+        except Exception as e:
+            # e.g. a full SD card, the frame is still decoded
+            metrics.increment("frame_archive_errors")
+            print(f"Error archiving frame: {e}")
+
+    started = time.perf_counter()
+    try:
+        plaintext = decrypt(data, key)
+    except Exception as e:
+        metrics.increment("decrypt_failures")
+        print(f"Error decrypting frame: {e}")
+        return None
+    decrypted = time.perf_counter()
+    try:
+        json_current = getJsonCurrent(plaintext)
+    except DecodeError as e:
+        # malformed or unsupported DataNotification, e.g. wrong key
+        metrics.increment("decode_errors")
+        print(f"Error decoding frame: {e}")
+        return None
+    except Exception as e:
+        metrics.increment("decode_failures")
+        print(f"Error decoding frame: {e}")
+        return None
+    metrics.observe("decrypt", decrypted - started)
+    metrics.observe("decode", time.perf_counter() - decrypted)
+    return json_current
+
+def writeSinks(sinks, json_currents):
+    """Pass decoded frames to the sinks, batches to sinks supporting it"""
+    for sink in sinks:
+        started = time.perf_counter()
+        try:
+            if len(json_currents) > 1 and hasattr(sink, "writeBatch"):
+                sink.writeBatch(json_currents)
+            else:
+                for json_current in json_currents:
+                    sink.write(json_current)
+        except Exception as e:
+            # a failing sink must not stop the others
+            metrics.increment("sink_errors")
+            print(f"Error writing to {type(sink).__name__}: {e}")
+        metrics.observe(f"sink_{type(sink).__name__}", time.perf_counter() - started)
+
+class Pipeline:
+    """Decoder and writer threads fed by the reader through bounded queues"""
+
+    def __init__(self, sinks, frame_archive=None, drop=True, frame_queue_size=None, decoded_queue_size=None):
+        self.sinks = sinks
+        self.frame_archive = frame_archive
+        # without dropping a full queue blocks the reader, used for captures
+        self.drop = drop
+        self.frames = queue.Queue(maxsize=frame_queue_size or config.pipeline_frame_queue_size)
+        self.decoded = queue.Queue(maxsize=decoded_queue_size or config.pipeline_decoded_queue_size)
+        self.decoder = threading.Thread(target=self.runDecoder, name="decoder", daemon=True)
+        self.writer = threading.Thread(target=self.runWriter, name="writer", daemon=True)
+
+    def start(self):
+        self.decoder.start()
+        self.writer.start()
+
+    def submit(self, data, key):
+        """Queue a received frame, never blocks in drop mode"""
+        # wall clock time for the frame archive, monotonic time for the latency
+        self.put(self.frames, (data, key, time.time(), time.perf_counter()), "frame")
+
+    def put(self, target, item, name):
+        if not self.drop:
+            target.put(item)
+        else:
+            try:
+                target.put_nowait(item)
+            except queue.Full:
+                # keep the newest entries
+                try:
+                    target.get_nowait()
+                    metrics.increment(f"pipeline_{name}_queue_dropped")
+                except queue.Empty:
+                    pass
+                target.put_nowait(item)
+        metrics.set(f"pipeline_{name}_queue_depth", target.qsize())
+
+    def runDecoder(self):
+        while True:
+            item = self.frames.get()
+            metrics.set("pipeline_frame_queue_depth", self.frames.qsize())
+            if item is None:
+                self.decoded.put(None)
+                return
+            # the thread must survive any frame, a dead decoder would stop the readout silently
+            try:
+                data, key, received, started = item
+                json_current = decodeFrame(data, key, self.frame_archive, received)
+                if json_current is not None:
+                    self.put(self.decoded, (json_current, started), "decoded")
+            except Exception as e:
+                metrics.increment("pipeline_errors")
+                print(f"Error in decoder: {e}")
+
+    def runWriter(self):
+        while True:
+            batch = [self.decoded.get()]
+            # take the backlog
+            while True:
+                try:
+                    batch.append(self.decoded.get_nowait())
+                except queue.Empty:
+                    break
+            metrics.set("pipeline_decoded_queue_depth", 0)
+
+            stop = batch[-1] is None
+            if stop:
+                batch.pop()
+            if batch:
+                try:
+                    if len(batch) > 1:
+                        metrics.increment("pipeline_coalesced_frames", len(batch) - 1)
+                    writeSinks(self.sinks, [json_current for json_current, started in batch])
+                    written = time.perf_counter()
+                    for json_current, started in batch:
+                        metrics.observe("pipeline_latency", written - started)
+                except Exception as e:
+                    metrics.increment("pipeline_errors")
+                    print(f"Error in writer: {e}")
+            if stop:
+                return
+
+    def stop(self, timeout=30):
+        """Process the queued frames and stop the threads"""
+        # a full queue must not block the shutdown
+        try:
+            self.frames.put(None, timeout=timeout)
+        except queue.Full:
+            # the decoder is stuck, the oldest frame makes room
+            try:
+                self.frames.get_nowait()
+            except queue.Empty:
+                pass
+            self.frames.put_nowait(None)
+        self.decoder.join(timeout)
+        self.writer.join(timeout)
@@ -0,0 +1,370 @@
+#######################################
+#
+# query.py
+#
+# Command line queries of the SmartMeter SQLite database and archive.
+#
+#######################################
+
+import argparse
+import csv
+import json
+import sys
+from datetime import datetime, timedelta
+
+from . import config
+from .database import (connect_database, get_current_readings, get_events, get_history, get_latest_meter_number,
+                       get_rollup, query_history_lttb, query_history_range, select_rollup)
+from .snapshot import SnapshotReader
+from .value_archive import readArchive
+
+def write_rows(rows, names, output_format, out=sys.stdout):
+    """Write rows while they are read, returns the number of rows"""
+    count = 0
+    if output_format == "csv":
+        writer = csv.writer(out)
+        writer.writerow(names)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    elif output_format == "ndjson":
+        for row in rows:
+            out.write(json.dumps(dict(zip(names, row)), default=str))
+            out.write("\n")
+            count += 1
+    else:
+        for row in rows:
+            out.write("[\n" if count == 0 else ",\n")
+            out.write(json.dumps(dict(zip(names, row)), indent=2, default=str))
+            count += 1
+        if count:
+            out.write("\n]\n")
+    return count
+
+def print_history_range(args):
+    """Stream raw or downsampled history in the requested format"""
+    end_time = datetime.fromisoformat(args.to) if args.to else datetime.now()
+    if args.start:
+        start_time = datetime.fromisoformat(args.start)
+    else:
+        start_time = end_time - timedelta(hours=args.hours)
+    
+    conn = connect_database()
+    if not conn:
+        return
+    conn.row_factory = None
+    cursor = conn.cursor()
+    meter_number = args.meter if args.meter else get_latest_meter_number(cursor)
+    
+    if args.points and args.method == "lttb":
+        rows = query_history_lttb(cursor, start_time, end_time, meter_number, args.points, args.field)
+        names = ["timestamp", "wirkenergie_bezug", "wirkenergie_lieferung"]
+    else:
+        rows = query_history_range(cursor, start_time, end_time, meter_number, args.points)
+        names = [column[0] for column in cursor.description]
+    
+    count = write_rows(rows, names, args.format)
+    conn.close()
+    if count == 0 and args.format == "json":
+        print("No history data found")
+
+def parse_history_range_args(argv):
+    parser = argparse.ArgumentParser(prog="query_database.py raw-history")
+    parser.add_argument("hours", nargs="?", type=float, default=24, help="hours before --to (default: 24)")
+    parser.add_argument("meter", nargs="?", help="meter number (default: meter of the latest reading)")
+    parser.add_argument("--from", dest="start", help="start time, ISO format")
+    parser.add_argument("--to", help="end time, ISO format (default: now)")
+    parser.add_argument("--points", type=int, help="downsample to about this many points")
+    parser.add_argument("--method", choices=["minmax", "lttb"], default="minmax",
+                        help="minmax: min/max per time bucket, lttb: largest triangle three buckets")
+    parser.add_argument("--field", choices=["wirkenergie_bezug", "wirkenergie_lieferung"],
+                        default="wirkenergie_bezug", help="value used by lttb")
+    parser.add_argument("--format", choices=["json", "ndjson", "csv"], default="json")
+    return parser.parse_args(argv)
+
+analytics_reports = ["profile", "peaks", "duration", "balance", "heatmap"]
+# fractions of the time for the load-duration curve
+duration_fractions = [0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99, 1.0]
+
+def parse_analytics_args(argv):
+    parser = argparse.ArgumentParser(prog="query_database.py analytics")
+    parser.add_argument("report", choices=analytics_reports)
+    parser.add_argument("hours", nargs="?", type=float, default=24 * 30, help="hours before --to (default: 30 days)")
+    parser.add_argument("meter", nargs="?", help="meter number (default: meter of the latest reading)")
+    parser.add_argument("--from", dest="start", help="start time, ISO format")
+    parser.add_argument("--to", help="end time, ISO format (default: now)")
+    parser.add_argument("--interval", type=float,
+                        help="interval in minutes (default: 15 for profile and peaks, 60 otherwise)")
+    parser.add_argument("--field", choices=["import", "export"], default="import",
+                        help="power used by peaks, duration and heatmap")
+    parser.add_argument("--format", choices=["table", "csv"], default="table")
+    return parser.parse_args(argv)
+
+def print_table(rows, names, output_format, decimals=1):
+    """Rows as aligned table or CSV, NaN is left empty"""
+    rows = [[None if value != value else value for value in row] for row in rows]
+    if output_format == "csv":
+        write_rows(rows, names, "csv")
+        return
+    rows = [["" if value is None else f"{value:.{decimals}f}" if isinstance(value, float) else str(value)
+             for value in row] for row in rows]
+    widths = [max([len(name)] + [len(row[i]) for row in rows]) for i, name in enumerate(names)]
+    print("  ".join(name.rjust(width) for name, width in zip(names, widths)))
+    for row in rows:
+        print("  ".join(value.rjust(width) for value, width in zip(row, widths)))
+
+def print_analytics(args):
+    """Print a report computed with NumPy over a history range"""
+    try:
+        from . import analytics
+    except ImportError:
+        print("The analytics reports need NumPy: python3 -m pip install numpy")
+        return
+    
+    end_time = datetime.fromisoformat(args.to) if args.to else datetime.now()
+    if args.start:
+        start_time = datetime.fromisoformat(args.start)
+    else:
+        start_time = end_time - timedelta(hours=args.hours)
+    
+    conn = connect_database()
+    if not conn:
+        return
+    conn.row_factory = None
+    cursor = conn.cursor()
+    meter_number = args.meter if args.meter else get_latest_meter_number(cursor)
+    seconds, imported, exported = analytics.load_history(cursor, start_time, end_time, meter_number)
+    conn.close()
+    if len(seconds) < 2:
+        print("No history data found")
+        return
+    
+    if args.report == "balance":
+        days, imported_day, exported_day = analytics.daily_balance(seconds, imported, exported)
+        rows = [[str(day), i, e, i - e] for day, i, e in
+                zip(days.astype("datetime64[s]").astype("datetime64[D]"), imported_day.tolist(), exported_day.tolist())]
+        rows.append(["total", float(imported_day.sum()), float(exported_day.sum()),
+                     float(imported_day.sum() - exported_day.sum())])
+        print_table(rows, ["day", "import_wh", "export_wh", "net_wh"], args.format)
+        return
+    
+    interval_minutes = args.interval or (15 if args.report in ("profile", "peaks") else 60)
+    interval = interval_minutes * 60
+    step = analytics.sample_step(seconds)
+    if step > interval and args.format == "table":
+        # older ranges are only kept in the hourly rollup
+        print(f"Note: the data has one sample per {step / 60:.0f} minutes, shorter intervals are interpolated")
+    grid, import_power, export_power = analytics.power_profile(seconds, imported, exported, interval)
+    power = import_power if args.field == "import" else export_power
+    
+    if args.report == "profile":
+        rows = [[str(start), i, e] for start, i, e in
+                zip(grid.astype("datetime64[s]"), import_power.tolist(), export_power.tolist())]
+        print_table(rows, ["interval_start", "import_w", "export_w"], args.format)
+    
+    elif args.report == "peaks":
+        days, peaks, starts = analytics.daily_peaks(grid, power)
+        rows = [[str(day), peak, str(start)] for day, peak, start in
+                zip(days.astype("datetime64[s]").astype("datetime64[D]"), peaks.tolist(), starts.astype("datetime64[s]"))]
+        print_table(rows, ["day", f"peak_{interval_minutes:g}min_{args.field}_w", "interval_start"], args.format)
+    
+    elif args.report == "duration":
+        values = analytics.load_duration(power, duration_fractions)
+        hours = analytics.covered_hours(power, interval)
+        rows = [[f"{fraction * 100:g}%", fraction * hours, value]
+                for fraction, value in zip(duration_fractions, values.tolist())]
+        print_table(rows, ["time_exceeded", "hours", f"{args.field}_w"], args.format)
+    
+    elif args.report == "heatmap":
+        matrix = analytics.heatmap(grid, power)
+        rows = [[name] + row for name, row in zip(analytics.weekdays, matrix.tolist())]
+        print_table(rows, ["day"] + [f"{hour:02d}" for hour in range(24)], args.format, decimals=0)
+
+def print_archive(hours=1, meter_number=None):
+    """Print all archived frames of the specified number of hours as CSV"""
+    if meter_number is None:
+        conn = connect_database()
+        if not conn:
+            return
+        meter_number = get_latest_meter_number(conn.cursor())
+        conn.close()
+    if meter_number is None:
+        print("No meter found in database")
+        return
+    
+    end_time = datetime.now()
+    columns = readArchive(config.archive_directory, meter_number, end_time - timedelta(hours=hours), end_time)
+    names = list(columns.keys())
+    print(",".join(names))
+    for row in zip(*[columns[name] for name in names]):
+        print(",".join("" if value is None else str(value) for value in row))
+
+def print_current_summary(shm=False):
+    """Print a summary of current readings"""
+    if shm:
+        # live values published by the readout, no database access
+        try:
+            reader = SnapshotReader()
+        except FileNotFoundError:
+            print(f"No snapshot found at {config.snapshot_file}")
+            return
+        readings = reader.readAll()
+        reader.close()
+        if not readings:
+            print("No current reading found in snapshot")
+            return
+    else:
+        readings = get_current_readings()
+    if not readings:
+        print("No current reading found in database")
+        return
+    
+    for current in readings:
+        print_reading(current)
+
+def print_reading(current):
+    print("=== Current Smart Meter Reading ===")
+    print(f"Timestamp: {current['timestamp']}")
+    print(f"Meter Number: {current['meter_number']}")
+    print(f"Energy Consumption (A+): {current['wirkenergie_bezug']} Wh")
+    print(f"Energy Production (A-): {current['wirkenergie_lieferung']} Wh")
+    print(f"Current Power Consumption: {current['wirkleistung_bezug']} W")
+    print(f"Current Power Production: {current['wirkleistung_lieferung']} W")
+    print(f"Voltage L1/L2/L3: {current['spannung_l1']}/{current['spannung_l2']}/{current['spannung_l3']} V")
+    print(f"Current L1/L2/L3: {current['strom_l1']}/{current['strom_l2']}/{current['strom_l3']} A")
+    print(f"Power Factor: {current['leistungsfaktor']}")
+
+def print_rollup_summary(hours=24, meter_number=None):
+    """Print a summary of aggregated historical data"""
+    table = select_rollup(hours)
+    rollup = get_rollup(hours, meter_number, table)
+    if not rollup:
+        print(f"No history data found for the last {hours} hours")
+        return
+    
+    latest = rollup[-1]
+    earliest = rollup[0]
+    print(f"=== History Summary (Last {hours} hours, from {table}) ===")
+    print(f"Number of periods: {len(rollup)}")
+    print(f"Time range: {earliest['first_timestamp']} to {latest['last_timestamp']}")
+    print(f"Latest energy consumption: {latest['wirkenergie_bezug_last']} Wh")
+    print(f"Latest energy production: {latest['wirkenergie_lieferung_last']} Wh")
+    
+    total_consumption_change = latest['wirkenergie_bezug_last'] - earliest['wirkenergie_bezug_first']
+    total_production_change = latest['wirkenergie_lieferung_last'] - earliest['wirkenergie_lieferung_first']
+    start_time = datetime.fromisoformat(earliest['first_timestamp'])
+    end_time = datetime.fromisoformat(latest['last_timestamp'])
+    time_span_hours = (end_time - start_time).total_seconds() / 3600
+    
+    if time_span_hours > 0:
+        print(f"Average consumption over period: {total_consumption_change / time_span_hours:.2f} W")
+        print(f"Average production over period: {total_production_change / time_span_hours:.2f} W")
+    print(f"Peak consumption power: {max(row['wirkleistung_bezug_max'] or 0 for row in rollup):.2f} W")
+    print(f"Peak production power: {max(row['wirkleistung_lieferung_max'] or 0 for row in rollup):.2f} W")
+    print(f"Total consumption change: {total_consumption_change:.2f} Wh")
+    print(f"Total production change: {total_production_change:.2f} Wh")
+
+def print_history_summary(hours=24, meter_number=None):
+    """Print a summary of historical data"""
+    if hours > config.history_keep_hours:
+        # older entries are only kept in the rollup tables
+        print_rollup_summary(hours, meter_number)
+        return
+    
+    history = get_history(hours, meter_number)
+    if not history:
+        print(f"No history data found for the last {hours} hours")
+        return
+    
+    print(f"=== History Summary (Last {hours} hours) ===")
+    print(f"Number of entries: {len(history)}")
+    
+    if history:
+        latest = history[-1]
+        earliest = history[0]
+        print(f"Time range: {earliest['timestamp']} to {latest['timestamp']}")
+        print(f"Latest energy consumption: {latest['wirkenergie_bezug']} Wh")
+        print(f"Latest energy production: {latest['wirkenergie_lieferung']} Wh")
+        
+        if len(history) >= 2:
+            # Calculate total energy change over the period
+            total_consumption_change = latest['wirkenergie_bezug'] - earliest['wirkenergie_bezug']
+            total_production_change = latest['wirkenergie_lieferung'] - earliest['wirkenergie_lieferung']
+            
+            # Calculate time span
+            start_time = datetime.fromisoformat(earliest['timestamp'])
+            end_time = datetime.fromisoformat(latest['timestamp'])
+            time_span_hours = (end_time - start_time).total_seconds() / 3600
+            
+            if time_span_hours > 0:
+                avg_consumption_power = total_consumption_change / time_span_hours
+                avg_production_power = total_production_change / time_span_hours
+                print(f"Average consumption over period: {avg_consumption_power:.2f} W")
+                print(f"Average production over period: {avg_production_power:.2f} W")
+                print(f"Total consumption change: {total_consumption_change:.2f} Wh")
+                print(f"Total production change: {total_production_change:.2f} Wh")
+
+def print_events(hours=24, meter_number=None):
+    """Print the threshold events of the event rules"""
+    events = get_events(hours, meter_number)
+    if not events:
+        print(f"No events found for the last {hours} hours")
+        return
+    
+    print(f"=== Events (Last {hours} hours) ===")
+    for event in events:
+        end = event['end_timestamp'] or "active"
+        print(f"{event['start_timestamp']} to {end}: {event['rule']} (peak {event['peak_value']:.2f})")
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python3 query_database.py <command> [options]")
+        print("Commands:")
+        print("  current [--shm] - Show current reading summary, --shm reads the live snapshot of the readout")
+        print("  history [hours] [meter] - Show history summary (default: 24 hours)")
+        print("  events [hours] [meter] - Show threshold events (default: 24 hours)")
+        print("  analytics profile|peaks|duration|balance|heatmap [hours] [meter] [--from T] [--to T]")
+        print("              [--interval MIN] [--field import|export] [--format table|csv]")
+        print("              - Reports over a history range, needs NumPy (default: 30 days)")
+        print("  raw-current     - Show raw current data")
+        print("  raw-history [hours] [meter] [--from T] [--to T] [--points N] [--method minmax|lttb]")
+        print("              [--format json|ndjson|csv] - Show raw history data (default: 24 hours)")
+        print("  raw-archive [hours] [meter] - Show all archived frames as CSV (default: 1 hour)")
+        print("Without a meter number the meter of the latest reading is used.")
+        return
+    
+    command = sys.argv[1]
+    
+    if command == "current":
+        print_current_summary("--shm" in sys.argv[2:])
+    
+    elif command == "history":
+        hours = int(sys.argv[2]) if len(sys.argv) > 2 else 24
+        meter_number = sys.argv[3] if len(sys.argv) > 3 else None
+        print_history_summary(hours, meter_number)
+    
+    elif command == "events":
+        hours = int(sys.argv[2]) if len(sys.argv) > 2 else 24
+        meter_number = sys.argv[3] if len(sys.argv) > 3 else None
+        print_events(hours, meter_number)
+    
+    elif command == "analytics":
+        print_analytics(parse_analytics_args(sys.argv[2:]))
+    
+    elif command == "raw-current":
+        data = get_current_readings()
+        if data:
+            print(json.dumps(data, indent=2, default=str))
+        else:
+            print("No current data found")
+    
+    elif command == "raw-history":
+        print_history_range(parse_history_range_args(sys.argv[2:]))
+    
+    elif command == "raw-archive":
+        hours = float(sys.argv[2]) if len(sys.argv) > 2 else 1
+        meter_number = sys.argv[3] if len(sys.argv) > 3 else None
+        print_archive(hours, meter_number)
+    
+    else:
+        print(f"Unknown command: {command}")
@@ -0,0 +1,339 @@
+#######################################
+#
+# readout.py
+#
+# Reads out the smart meter and passes the decoded frames to the sinks:
+# database, value archive and HTTP API.
+# More details can be found in my blog post: 
+# https://projekte.philippseverin.at/2023/08/04/smartmeter-mit-raspberrypi-auslesen/
+#
+# Inspired by and based on:
+# https://github.com/micronano0/RaspberryPi-Kaifa-SmartMeter-Reader/blob/main/kaifa_kundenschnittstelle_auslesen.py
+#
+# Nothing is opened or created on import, main() sets up directories,
+# database and backup before reading.
+#
+#######################################
+
+import argparse
+import asyncio
+from datetime import datetime
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+
+from . import config
+from .backup import backupLoop, backup_database, ensure_directories, restore_database
+from .database import (DatabaseWriter, get_history, init_database, lock_database, rollup_tables,
+                       sql_history_conflict)
+from .dlms import archive_fields, decrypt, getJsonCurrent
+from .events import ChangeFilter, EventEngine
+from .exporter import LineProtocolExporter
+from .frame_archive import FrameArchive, readFrames
+from .framing import MbusFramer, readPacket
+from .http_api import FrameHub, LatestReading, startApiServer, startMetricsServer
+from .metrics import metrics, metricsFileLoop
+from .pipeline import Pipeline
+from .snapshot import SharedSnapshot
+from .sync import SyncAgent, resetState, syncLoop
+from .transports import FileTransport, SerialTransport, SimulatorTransport, loadCaptureFrames
+from .value_archive import ValueArchive
+
+def readKey(key_path=None):
+    # read key from file
+    key_file = open(key_path or config.key_file, "r")
+    key_string = key_file.readline().strip()
+    key_file.close()
+    return bytes.fromhex(key_string)
+
+#######################################
+# Multiple meters
+#
+# Several meters are read concurrently by one process. Each serial port
+# is watched by the asyncio event loop and has its own key and framer,
+# all meters feed the same pipeline and database keyed by meter_number.
+
+class MeterReader:
+    """Reads one meter on the asyncio event loop"""
+
+    def __init__(self, transport, key, pipeline):
+        self.transport = transport
+        self.key = key
+        self.pipeline = pipeline
+        self.framer = MbusFramer()
+
+    def start(self, loop):
+        loop.add_reader(self.transport.fileno(), self.onReadable)
+
+    def stop(self, loop):
+        loop.remove_reader(self.transport.fileno())
+        self.transport.close()
+
+    def onReadable(self):
+        started = time.perf_counter()
+        self.framer.feed(self.transport.read())
+        metrics.observe("framing", time.perf_counter() - started)
+        while self.framer.frames:
+            self.pipeline.submit(self.framer.frames.popleft(), self.key)
+
+async def runMultiReadout(meters, pipeline):
+    loop = asyncio.get_running_loop()
+    readers = []
+    for port, key_path in meters:
+        reader = MeterReader(SerialTransport(port), readKey(key_path), pipeline)
+        reader.start(loop)
+        readers.append(reader)
+    try:
+        # the readers run in callbacks of the event loop
+        await asyncio.Event().wait()
+    finally:
+        for reader in readers:
+            reader.stop(loop)
+
+def parseMeter(value):
+    # PORT=KEYFILE
+    port, _, key_path = value.partition("=")
+    return (port, key_path or config.key_file)
+
+#######################################
+# Main
+#
+# Decoded frames are passed to a list of sinks, every sink has a
+# write(json_current) and a close() method. Sinks are closed in reverse
+# order, the event engine writes through the connection of the writer.
+
+def createSinks(args):
+    change_filter = None
+    if config.change_filter_enabled:
+        change_filter = ChangeFilter(config.change_deadbands, config.change_max_age_seconds)
+    writer = DatabaseWriter(change_filter=change_filter)
+    sinks = [writer]
+    if config.event_rules:
+        # uses the connection of the writer, both run on the writer thread
+        sinks.append(EventEngine(writer, config.event_rules))
+    if config.snapshot_enabled:
+        sinks.append(SharedSnapshot())
+    if config.archive_enabled:
+        sinks.append(ValueArchive(config.archive_directory, archive_fields))
+    if args.export_url:
+        sinks.append(LineProtocolExporter(args.export_url, config.export_token))
+    if args.http_port:
+        latest = LatestReading(FrameHub())
+        sinks.append(latest)
+        startApiServer(args.http_port, latest, writer, get_history, args.http_host)
+    return sinks
+
+def closeSinks(sinks):
+    # reverse order, sinks may depend on earlier ones
+    for sink in reversed(sinks):
+        try:
+            sink.close()
+        except Exception as e:
+            print(f"Error closing {type(sink).__name__}: {e}")
+
+def runReadout(transport, key, pipeline):
+    # the reader stage, decoding and writing run on the pipeline threads
+    framer = MbusFramer()
+    while True:
+        #print("Reading data...")
+        pipeline.submit(readPacket(transport, framer), key)
+
+def decodeFrameChunk(chunk):
+    """Decode a chunk of (receive time, frame), runs in the worker processes"""
+    key, frames = chunk
+    decoded = []
+    errors = []
+    for received, data in frames:
+        try:
+            decoded.append(getJsonCurrent(decrypt(data, key)))
+        except Exception as e:
+            errors.append(f"Error decoding frame received {datetime.fromtimestamp(received)}: {e}")
+    return decoded, errors
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def keepOldRows(rebuild_file, database_file):
+    """Copy what the frame archive cannot restore from the old database"""
+    if not os.path.exists(database_file):
+        return
+    conn = sqlite3.connect(rebuild_file)
+    conn.execute('ATTACH DATABASE ? AS old', (database_file,))
+    # first archived frame of every meter, the rollups keep every frame
+    conn.execute('''
+        CREATE TEMP TABLE archive_start AS
+        SELECT meter_number, MIN(first_timestamp) AS first_timestamp FROM main.history_monthly GROUP BY meter_number
+    ''')
+    for table, _ in rollup_tables:
+        # periods before the archive or only partly covered by it are complete in the old database
+        conn.execute(f'''
+            INSERT OR REPLACE INTO {table}
+            SELECT rollup.* FROM old.{table} AS rollup JOIN archive_start
+                ON archive_start.meter_number IS rollup.meter_number
+            WHERE rollup.period_start <= archive_start.first_timestamp
+        ''')
+        # meters and gaps without archived frames
+        conn.execute(f'INSERT OR IGNORE INTO {table} SELECT * FROM old.{table}')
+    # history entries before the first archived frame, a newer entry keeps its slot
+    conn.execute(f'''
+        INSERT INTO history (meter_number, slot, timestamp, wirkenergie_bezug, wirkenergie_lieferung)
+        SELECT meter_number, slot, timestamp, wirkenergie_bezug, wirkenergie_lieferung FROM old.history AS entry
+        WHERE NOT EXISTS (SELECT 1 FROM archive_start
+                          WHERE archive_start.meter_number IS entry.meter_number
+                            AND archive_start.first_timestamp <= entry.timestamp)
+        {sql_history_conflict}
+    ''')
+    conn.execute('''
+        INSERT INTO events (meter_number, rule, start_timestamp, end_timestamp, peak_value)
+        SELECT meter_number, rule, start_timestamp, end_timestamp, peak_value FROM old.events
+    ''')
+    conn.commit()
+    conn.execute('DETACH DATABASE old')
+    conn.close()
+
+def rebuildDatabase(directory, key, workers=None, chunk_size=2000):
+    """Decode all frames of the raw frame archive again into the database.
+
+    The frames are written in order into a fresh database, which then
+    replaces the current one. Rollup periods before the start of the
+    archive and the events are taken over from the current database.
+    Chunks of frames are decrypted and decoded by a process pool, the
+    results are written in order with one transaction per chunk.
+    The caller holds the lock of lock_database(), so no readout writes
+    to the database that is replaced. The marks of the sync agent are
+    reset, the aggregator receives the rebuilt rows again.
+    """
+    rebuild_file = config.database_file + ".rebuild"
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(rebuild_file + suffix):
+            os.remove(rebuild_file + suffix)
+    init_database(rebuild_file)
+
+    writer = DatabaseWriter(rebuild_file)
+    frames = 0
+    errors = 0
+    entries = 0
+    chunks = ((key, chunk) for chunk in chunked(readFrames(directory), chunk_size))
+    try:
+        with multiprocessing.Pool(workers) as pool:
+            for decoded, chunk_errors in pool.imap(decodeFrameChunk, chunks):
+                for error in chunk_errors:
+                    print(error)
+                entries += writer.writeBatch(decoded)
+                frames += len(decoded)
+                errors += len(chunk_errors)
+    finally:
+        writer.close()
+
+    keepOldRows(rebuild_file, config.database_file)
+    # swap in the rebuilt database, the readout is not running
+    for suffix in ("-wal", "-shm"):
+        if os.path.exists(config.database_file + suffix):
+            os.remove(config.database_file + suffix)
+    os.replace(rebuild_file, config.database_file)
+    if os.path.exists(config.sync_state_file):
+        # rebuilt rows lie below the marks of the sync agent, replicate everything again
+        resetState()
+    print(f"Rebuilt database from {frames} frames: {entries} history entries written, "
+          f"{errors} frames could not be decoded")
+
+def main():
+    parser = argparse.ArgumentParser(description="Read out the smart meter")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--port", default=config.serial_port, help="serial port of the M-Bus adapter")
+    source.add_argument("--capture", help="read captured frames from a file")
+    source.add_argument("--simulate", help="replay captured frames through a pseudo-terminal")
+    source.add_argument("--meter", type=parseMeter, action="append",
+                        help="read several meters, given as PORT=KEYFILE, can be repeated")
+    parser.add_argument("--fast", action="store_true", help="replay as fast as possible instead of 2400 baud timing")
+    parser.add_argument("--archive-frames", action="store_true", default=config.frame_archive_enabled,
+                        help="keep the raw encrypted frames in the frame archive")
+    parser.add_argument("--rebuild", metavar="DIRECTORY",
+                        help="decode the frame archive in DIRECTORY into the database and exit")
+    parser.add_argument("--workers", type=int, help="processes used by --rebuild (default: number of CPUs)")
+    parser.add_argument("--http-port", type=int, default=config.http_port, help="serve the HTTP API on this port")
+    parser.add_argument("--http-host", default=config.http_host, help="address the HTTP API listens on")
+    parser.add_argument("--export-url", default=config.export_url,
+                        help="send the values in InfluxDB line protocol to this write URL")
+    parser.add_argument("--sync-url", default=config.sync_url,
+                        help="replicate the history to the aggregator at this URL")
+    parser.add_argument("--metrics-port", type=int, default=config.metrics_port,
+                        help="serve Prometheus metrics on this port of localhost")
+    parser.add_argument("--metrics-file", default=config.metrics_file,
+                        help="write Prometheus metrics to this file every minute")
+    args = parser.parse_args()
+
+    ensure_directories()
+
+    # a second readout or a rebuild would replace the database under the other
+    database_lock = lock_database()
+    if database_lock is None:
+        raise SystemExit(f"{config.database_file} is in use by another readout or rebuild")
+
+    # Restore database on startup, then create missing tables
+    restore_database()
+    init_database()
+
+    if args.rebuild:
+        rebuildDatabase(args.rebuild, readKey(), args.workers)
+        backup_database()
+        return
+
+    frame_archive = FrameArchive(config.frame_archive_directory) if args.archive_frames else None
+
+    if args.metrics_port:
+        startMetricsServer(args.metrics_port)
+    if args.metrics_file:
+        threading.Thread(target=metricsFileLoop, args=(args.metrics_file,), name="metrics-file", daemon=True).start()
+    if args.sync_url:
+        agent = SyncAgent(args.sync_url, config.sync_token)
+        threading.Thread(target=syncLoop, args=(agent,), name="sync", daemon=True).start()
+
+    if args.meter:
+        sinks = createSinks(args)
+        pipeline = Pipeline(sinks, frame_archive)
+        pipeline.start()
+        threading.Thread(target=backupLoop, name="backup", daemon=True).start()
+        try:
+            asyncio.run(runMultiReadout(args.meter, pipeline))
+        finally:
+            pipeline.stop()
+            closeSinks(sinks)
+            if frame_archive is not None:
+                frame_archive.close()
+            backup_database()
+        return
+
+    if args.capture:
+        transport = FileTransport(args.capture)
+    elif args.simulate:
+        transport = SimulatorTransport(loadCaptureFrames(args.simulate), realtime=not args.fast)
+    else:
+        transport = SerialTransport(args.port)
+
+    key = readKey()
+    sinks = createSinks(args)
+    # a capture is read faster than it is written, wait instead of dropping
+    pipeline = Pipeline(sinks, frame_archive, drop=not args.capture)
+    pipeline.start()
+    threading.Thread(target=backupLoop, name="backup", daemon=True).start()
+    try:
+        runReadout(transport, key, pipeline)
+    except EOFError:
+        pass
+    finally:
+        pipeline.stop()
+        closeSinks(sinks)
+        if frame_archive is not None:
+            frame_archive.close()
+        transport.close()
+        backup_database()
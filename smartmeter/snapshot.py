@@ -0,0 +1,201 @@
+#######################################
+#
+# snapshot.py
+#
+# Latest decoded frame of every meter in a memory mapped file on tmpfs,
+# so local processes can read the live values without SQLite.
+#
+# File layout (little endian):
+#   header : b'SMSH', version, slot count, slot size, field count, retired
+#   slots  : one per meter, at header_size + index * slot size
+#            sequence, receive time (unix), meter number, logical device
+#            name, meter timestamp, one float64 per field (NaN if missing)
+#
+# Every slot is guarded by a sequence counter (seqlock): the writer makes
+# it odd before and even after changing the slot. A reader copies the
+# slot and retries if the counter was odd or changed in between, so
+# readers never take a lock and never block the writer.
+#
+# The readout reuses a compatible file on start. An incompatible one is
+# replaced by a new file and marked as retired, readers that still map
+# it see the flag and map the new file.
+#
+#######################################
+
+import math
+import mmap
+import os
+import struct
+import time
+
+from . import config
+from .database import field_columns
+
+snapshot_magic = b'SMSH'
+snapshot_version = 2
+snapshot_slots = 8
+
+header = struct.Struct("<4sHHIII")
+header_size = 64
+# offset of the retired flag in the header
+retired = struct.Struct("<I")
+retired_offset = header.size - retired.size
+sequence = struct.Struct("<Q")
+slot_body = struct.Struct("<d16s32s20s4x13d")
+slot_size = sequence.size + slot_body.size
+
+class SharedSnapshot:
+    """Sink publishing every frame into the snapshot file"""
+
+    def __init__(self, path=None):
+        self.path = path or config.snapshot_file
+        expected = header.pack(snapshot_magic, snapshot_version, snapshot_slots, slot_size, len(field_columns), 0)
+        # meter number : slot index
+        self.slots = {}
+        try:
+            self.file = open(self.path, "r+b")
+            current = self.file.read(header.size)
+        except FileNotFoundError:
+            self.file = None
+            current = b""
+        if current == expected:
+            # readers keep their mapping, the meters keep their slots
+            self.buffer = mmap.mmap(self.file.fileno(), 0)
+            self.restoreSlots()
+            return
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as snapshot_file:
+            snapshot_file.write(expected.ljust(header_size, b'\0'))
+            snapshot_file.truncate(header_size + snapshot_slots * slot_size)
+        os.replace(tmp_path, self.path)
+        if self.file is not None:
+            # readers of the old file map the new one
+            if current[:4] == snapshot_magic and len(current) == header.size:
+                self.file.seek(retired_offset)
+                self.file.write(retired.pack(1))
+            self.file.close()
+        self.file = open(self.path, "r+b")
+        self.buffer = mmap.mmap(self.file.fileno(), 0)
+
+    def restoreSlots(self):
+        for index in range(snapshot_slots):
+            offset = header_size + index * slot_size
+            count = sequence.unpack_from(self.buffer, offset)[0]
+            if count == 0:
+                continue
+            if count & 1:
+                # a write was interrupted, the next write of the slot completes it
+                sequence.pack_into(self.buffer, offset, count + 1)
+            meter_number = slot_body.unpack_from(self.buffer, offset + sequence.size)[1]
+            self.slots[meter_number.rstrip(b'\0').decode("ascii")] = index
+
+    def write(self, json_current):
+        meter_number = json_current.get("Zaehlernummer", {}).get("value") or ""
+        index = self.slots.get(meter_number)
+        if index is None:
+            # more meters than slots overwrite the last slot
+            index = min(len(self.slots), snapshot_slots - 1)
+            self.slots[meter_number] = index
+
+        values = []
+        for name, column in field_columns:
+            value = json_current.get(name, {}).get("value")
+            values.append(math.nan if value is None else value)
+        body = slot_body.pack(time.time(),
+                              meter_number.encode("ascii", "replace"),
+                              (json_current.get("Logical Device Name", {}).get("value") or "").encode("ascii", "replace"),
+                              str(json_current["Datum"]["value"]).encode("ascii"),
+                              *values)
+
+        offset = header_size + index * slot_size
+        buffer = self.buffer
+        count = sequence.unpack_from(buffer, offset)[0]
+        sequence.pack_into(buffer, offset, count + 1)
+        buffer[offset + sequence.size:offset + slot_size] = body
+        sequence.pack_into(buffer, offset, count + 2)
+
+    def close(self):
+        self.buffer.close()
+        self.file.close()
+
+class SnapshotReader:
+    """Lock free reader of the snapshot file, keeps the file mapped between reads"""
+
+    def __init__(self, path=None, retries=1000):
+        self.path = path or config.snapshot_file
+        self.retries = retries
+        self.map()
+
+    def map(self):
+        with open(self.path, "rb") as snapshot_file:
+            self.buffer = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.slot_count, size, fields, _ = header.unpack_from(self.buffer, 0)
+        if magic != snapshot_magic or version != snapshot_version or size != slot_size or fields != len(field_columns):
+            self.buffer.close()
+            raise Exception(f"{self.path} is not a compatible snapshot file")
+
+    def remapIfRetired(self):
+        # the readout replaced the file, the old mapping is not written anymore
+        if retired.unpack_from(self.buffer, retired_offset)[0]:
+            self.buffer.close()
+            self.map()
+
+    def readSlot(self, index):
+        """Consistent copy of a slot as dict like a current_readings row, None if empty"""
+        offset = header_size + index * slot_size
+        buffer = self.buffer
+        for attempt in range(self.retries):
+            before = sequence.unpack_from(buffer, offset)[0]
+            if before & 1:
+                continue
+            body = buffer[offset + sequence.size:offset + slot_size]
+            if sequence.unpack_from(buffer, offset)[0] == before:
+                break
+        else:
+            raise Exception(f"No consistent snapshot of slot {index}")
+        if before == 0:
+            return None
+
+        received, meter_number, logical_device_name, timestamp, *values = slot_body.unpack(body)
+        reading = {
+            "timestamp": timestamp.rstrip(b'\0').decode("ascii"),
+            "meter_number": meter_number.rstrip(b'\0').decode("ascii") or None,
+            "logical_device_name": logical_device_name.rstrip(b'\0').decode("ascii") or None,
+        }
+        for (name, column), value in zip(field_columns, values):
+            reading[column] = None if math.isnan(value) else value
+        reading["received"] = received
+        return reading
+
+    def readAll(self):
+        """Latest reading of every meter"""
+        self.remapIfRetired()
+        readings = []
+        for index in range(self.slot_count):
+            reading = self.readSlot(index)
+            if reading is not None:
+                readings.append(reading)
+        return readings
+
+    def read(self, meter_number=None):
+        """Latest reading of a meter, without meter number the most recently received one"""
+        readings = [reading for reading in self.readAll()
+                    if meter_number is None or reading["meter_number"] == meter_number]
+        if not readings:
+            return None
+        return max(readings, key=lambda reading: reading["received"])
+
+    def close(self):
+        self.buffer.close()
+
+def read_snapshot(meter_number=None, path=None):
+    """Read the latest reading once from the snapshot file, None if there is none"""
+    try:
+        reader = SnapshotReader(path)
+    except FileNotFoundError:
+        return None
+    try:
+        return reader.read(meter_number)
+    finally:
+        reader.close()
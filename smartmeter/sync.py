@@ -0,0 +1,380 @@
+#######################################
+#
+# sync.py
+#
+# Replication of the history of many sites to a central aggregator.
+#
+# The agent runs on every Pi. For every table and meter it keeps a
+# high-water mark, the newest timestamp the aggregator confirmed, in a
+# small state file on persistent storage. Every sync it reads the rows
+# newer than the marks, sends them as gzip compressed JSON with one
+# list per row and moves the marks only after the aggregator accepted
+# the batch. After an outage it continues at the marks, a lost response
+# only causes rows to be sent again.
+#
+# The aggregator merges the batches into one database keyed by
+# meter_number. Every merge is an upsert, so repeated batches change
+# nothing. Unlike the ring of the sites the central history keeps every
+# entry.
+#
+#   agent      : history       rows with timestamp > mark
+#                history_*     rollup rows with last_timestamp > mark
+#                              (the current period is sent again while it grows)
+#   aggregator : POST /sync    merge a batch, returns the number of rows
+#
+#######################################
+
+import argparse
+from datetime import datetime
+import gzip
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from . import config
+from .database import rollup_tables
+from .metrics import metrics
+
+history_columns = ["meter_number", "timestamp", "wirkenergie_bezug", "wirkenergie_lieferung"]
+rollup_columns = [
+    "meter_number", "period_start", "samples", "first_timestamp", "last_timestamp",
+    "wirkenergie_bezug_first", "wirkenergie_bezug_last", "wirkenergie_bezug_min", "wirkenergie_bezug_max",
+    "wirkenergie_lieferung_first", "wirkenergie_lieferung_last", "wirkenergie_lieferung_min",
+    "wirkenergie_lieferung_max",
+    "wirkleistung_bezug_avg", "wirkleistung_bezug_max", "wirkleistung_lieferung_avg", "wirkleistung_lieferung_max",
+]
+
+sync_tables = [
+    # table           , columns        , column of the high-water mark, start of the period of a timestamp
+    ("history",         history_columns, "timestamp",      None),
+] + [
+    (table,             rollup_columns,  "last_timestamp", period) for table, period in rollup_tables
+]
+
+#######################################
+# Agent
+
+def loadState(state_file=None):
+    """High-water marks as {table: {meter number: timestamp}}"""
+    try:
+        with open(state_file or config.sync_state_file) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+def saveState(state, state_file=None):
+    state_file = state_file or config.sync_state_file
+    with open(state_file + ".tmp", "w") as file:
+        json.dump(state, file)
+    os.replace(state_file + ".tmp", state_file)
+
+def resetState(state_file=None):
+    """Forget the marks, e.g. after rows were written below them by a rebuild"""
+    saveState({}, state_file)
+
+# meters of all synced tables, a meter may only have rollup rows
+sql_sync_meters = " UNION ".join(f"SELECT meter_number FROM {table}" for table, _, _, _ in sync_tables)
+
+def readChanges(conn, state, limit):
+    """Rows newer than the marks, at most limit in total, and the marks after them"""
+    tables = {}
+    marks = {}
+    remaining = limit
+    meters = [row[0] for row in conn.execute(sql_sync_meters)]
+    for table, columns, mark_column, period in sync_tables:
+        if remaining <= 0:
+            break
+        rows = []
+        for meter_number in meters:
+            mark = state.get(table, {}).get(str(meter_number), "")
+            if period is None:
+                cursor = conn.execute(f'''
+                    SELECT {", ".join(columns)} FROM {table}
+                    WHERE meter_number IS ? AND timestamp > ?
+                    ORDER BY timestamp LIMIT ?
+                ''', (meter_number, mark, remaining))
+            else:
+                # only periods that can end after the mark, uses the primary key
+                start = str(period(datetime.fromisoformat(mark))) if mark else ""
+                cursor = conn.execute(f'''
+                    SELECT {", ".join(columns)} FROM {table}
+                    WHERE meter_number IS ? AND period_start >= ? AND last_timestamp > ?
+                    ORDER BY last_timestamp LIMIT ?
+                ''', (meter_number, start, mark, remaining))
+            meter_rows = cursor.fetchall()
+            if meter_rows:
+                rows += meter_rows
+                marks.setdefault(table, {})[str(meter_number)] = meter_rows[-1][columns.index(mark_column)]
+                remaining -= len(meter_rows)
+        if rows:
+            tables[table] = {"columns": columns, "rows": rows}
+    return tables, marks
+
+class SyncAgent:
+    """Sends the new rows of the local database to the aggregator"""
+
+    def __init__(self, url, token=None, site=None, database_file=None, state_file=None, batch_rows=None):
+        self.url = url
+        self.token = token
+        self.site = site or config.sync_site or socket.gethostname()
+        self.database_file = database_file or config.database_file
+        self.state_file = state_file or config.sync_state_file
+        self.batch_rows = batch_rows or config.sync_batch_rows
+        self.state = loadState(self.state_file)
+        self.failing = False
+
+    def sync(self):
+        """Send batches until nothing is new, False if the aggregator could not be reached"""
+        conn = sqlite3.connect(self.database_file, timeout=10)
+        try:
+            while True:
+                started = time.perf_counter()
+                tables, marks = readChanges(conn, self.state, self.batch_rows)
+                if not tables:
+                    return True
+                rows = sum(len(table["rows"]) for table in tables.values())
+                if not self.post({"site": self.site, "tables": tables}):
+                    return False
+                for table, meters in marks.items():
+                    self.state.setdefault(table, {}).update(meters)
+                saveState(self.state, self.state_file)
+                metrics.increment("sync_sent_rows", rows)
+                metrics.observe("sync", time.perf_counter() - started)
+                if rows < self.batch_rows:
+                    return True
+        finally:
+            conn.close()
+
+    def post(self, batch):
+        payload = gzip.compress(json.dumps(batch, separators=(",", ":")).encode("utf-8"))
+        headers = {"Content-Type": "application/json", "Content-Encoding": "gzip"}
+        if self.token:
+            headers["Authorization"] = f"Token {self.token}"
+        request = urllib.request.Request(self.url, data=payload, headers=headers, method="POST")
+        try:
+            with urllib.request.urlopen(request, timeout=config.sync_timeout_seconds) as response:
+                response.read()
+        except (urllib.error.URLError, OSError) as e:
+            # rejected batches are retried as well, nothing is lost until the
+            # aggregator accepts them
+            if not self.failing:
+                print(f"Sync to {self.url} failed, retrying: {e}")
+            self.failing = True
+            metrics.increment("sync_failures")
+            return False
+        if self.failing:
+            print(f"Sync to {self.url} recovered")
+        self.failing = False
+        metrics.increment("sync_bytes", len(payload))
+        return True
+
+    def reset(self):
+        """Forget the marks, the next sync sends everything again"""
+        self.state = {}
+        resetState(self.state_file)
+
+def syncLoop(agent):
+    # runs in its own thread, off the readout loop
+    while True:
+        time.sleep(config.sync_interval_minutes * 60)
+        try:
+            agent.sync()
+        except Exception as e:
+            print(f"Error syncing: {e}")
+
+#######################################
+# Aggregator
+
+sql_merge_history = f'''
+    INSERT INTO history (site, {", ".join(history_columns)}) VALUES (?, {", ".join("?" * len(history_columns))})
+    ON CONFLICT(meter_number, timestamp) DO UPDATE SET
+        site = excluded.site,
+        wirkenergie_bezug = excluded.wirkenergie_bezug,
+        wirkenergie_lieferung = excluded.wirkenergie_lieferung
+'''
+# a period is replaced by a later state of it, never by an older one
+sql_merge_rollup = '''
+    INSERT INTO {table} (site, {columns}) VALUES (?, {parameters})
+    ON CONFLICT(meter_number, period_start) DO UPDATE SET site = excluded.site, {updates}
+    WHERE excluded.last_timestamp >= {table}.last_timestamp
+'''
+
+def merge_statement(table, columns):
+    if table == "history":
+        return sql_merge_history
+    return sql_merge_rollup.format(
+        table=table, columns=", ".join(columns), parameters=", ".join("?" * len(columns)),
+        updates=", ".join(f"{column} = excluded.{column}" for column in columns[2:]))
+
+def init_aggregator_database(database_file=None):
+    conn = sqlite3.connect(database_file or config.sync_aggregator_database)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS history (
+            site TEXT,
+            meter_number TEXT,
+            timestamp DATETIME,
+            wirkenergie_bezug REAL,
+            wirkenergie_lieferung REAL,
+            PRIMARY KEY (meter_number, timestamp)
+        ) WITHOUT ROWID
+    ''')
+    # the rollup tables of the sites with the site
+    for table, _ in rollup_tables:
+        conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                site TEXT,
+                meter_number TEXT,
+                period_start DATETIME,
+                samples INTEGER,
+                first_timestamp DATETIME,
+                last_timestamp DATETIME,
+                wirkenergie_bezug_first REAL,
+                wirkenergie_bezug_last REAL,
+                wirkenergie_bezug_min REAL,
+                wirkenergie_bezug_max REAL,
+                wirkenergie_lieferung_first REAL,
+                wirkenergie_lieferung_last REAL,
+                wirkenergie_lieferung_min REAL,
+                wirkenergie_lieferung_max REAL,
+                wirkleistung_bezug_avg REAL,
+                wirkleistung_bezug_max REAL,
+                wirkleistung_lieferung_avg REAL,
+                wirkleistung_lieferung_max REAL,
+                PRIMARY KEY (meter_number, period_start)
+            )
+        ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sites (
+            site TEXT PRIMARY KEY,
+            last_sync DATETIME,
+            rows INTEGER
+        )
+    ''')
+    conn.commit()
+    conn.close()
+
+class Aggregator:
+    """Merges the batches of the sites into the central database"""
+
+    def __init__(self, database_file=None):
+        self.conn = sqlite3.connect(database_file or config.sync_aggregator_database, isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.lock = threading.Lock()
+        self.statements = {table: merge_statement(table, columns) for table, columns, _, _ in sync_tables}
+        self.columns = {table: columns for table, columns, _, _ in sync_tables}
+
+    def merge(self, batch):
+        """Merge one batch in one transaction, returns the number of rows"""
+        site = str(batch["site"])
+        merged = 0
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute('BEGIN')
+            try:
+                for table, content in batch["tables"].items():
+                    # only known tables with the columns of this version
+                    if self.columns.get(table) != content["columns"]:
+                        raise ValueError(f"Unexpected table {table} or columns")
+                    cursor.executemany(self.statements[table], ([site] + row for row in content["rows"]))
+                    merged += len(content["rows"])
+                cursor.execute('''
+                    INSERT INTO sites (site, last_sync, rows) VALUES (?, datetime('now', 'localtime'), ?)
+                    ON CONFLICT(site) DO UPDATE SET last_sync = excluded.last_sync, rows = rows + excluded.rows
+                ''', (site, merged))
+                cursor.execute('COMMIT')
+            except Exception:
+                cursor.execute('ROLLBACK')
+                raise
+        return merged
+
+    def close(self):
+        self.conn.close()
+
+class AggregatorHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != "/sync":
+            self.send_error(404)
+            return
+        token = self.server.token
+        if token and self.headers.get("Authorization") != f"Token {token}":
+            self.send_error(401)
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.headers.get("Content-Encoding") == "gzip":
+                body = gzip.decompress(body)
+            merged = self.server.aggregator.merge(json.loads(body))
+        except (ValueError, KeyError, TypeError, OSError, sqlite3.Error) as e:
+            self.send_error(400, str(e))
+            return
+        response = json.dumps({"rows": merged}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+def startAggregatorServer(port, aggregator, token=None, host=""):
+    """Serve POST /sync from a background thread, returns the server"""
+    server = ThreadingHTTPServer((host, port), AggregatorHandler)
+    server.daemon_threads = True
+    server.aggregator = aggregator
+    server.token = token
+    threading.Thread(target=server.serve_forever, name="aggregator", daemon=True).start()
+    return server
+
+#######################################
+# Command line
+
+def main():
+    parser = argparse.ArgumentParser(description="Replicate the history of many sites to a central aggregator")
+    commands = parser.add_subparsers(dest="command", required=True)
+    agent_parser = commands.add_parser("agent", help="send the new rows of this site")
+    agent_parser.add_argument("--url", default=config.sync_url, help="aggregator URL, e.g. http://central:8090/sync")
+    agent_parser.add_argument("--token", default=config.sync_token)
+    agent_parser.add_argument("--site", default=config.sync_site, help="name of this site (default: host name)")
+    agent_parser.add_argument("--once", action="store_true", help="sync once and exit, e.g. from cron")
+    agent_parser.add_argument("--reset", action="store_true", help="forget the high-water marks and send everything")
+    aggregator_parser = commands.add_parser("aggregator", help="merge the batches of the sites")
+    aggregator_parser.add_argument("--port", type=int, default=config.sync_aggregator_port)
+    aggregator_parser.add_argument("--host", default="")
+    aggregator_parser.add_argument("--database", default=config.sync_aggregator_database)
+    aggregator_parser.add_argument("--token", default=config.sync_token)
+    args = parser.parse_args()
+
+    if args.command == "agent":
+        if not args.url:
+            parser.error("no aggregator URL, use --url or set sync_url")
+        agent = SyncAgent(args.url, args.token, args.site)
+        if args.reset:
+            agent.reset()
+        if args.once:
+            raise SystemExit(0 if agent.sync() else 1)
+        agent.sync()
+        syncLoop(agent)
+    else:
+        init_aggregator_database(args.database)
+        aggregator = Aggregator(args.database)
+        server = startAggregatorServer(args.port, aggregator, args.token, args.host)
+        print(f"Aggregator listening on port {args.port}, database {args.database}")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.shutdown()
+            aggregator.close()
+
+if __name__ == "__main__":
+    main()
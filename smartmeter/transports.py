@@ -0,0 +1,114 @@
+#######################################
+#
+# transports.py
+#
+# A transport delivers the raw bytes sent by the meter. read() blocks
+# until at least one byte is available and returns all available bytes.
+#
+#######################################
+
+import os
+import pty
+import threading
+import time
+import tty
+
+from . import config
+from .framing import MbusFramer
+
+class SerialTransport:
+    """Serial port with the M-Bus adapter"""
+
+    def __init__(self, port=None):
+        # pyserial is only needed when a serial port is opened
+        import serial
+        self.ser = serial.Serial(port or config.serial_port, 
+                                 baudrate=config.serial_baudrate, 
+                                 parity=serial.PARITY_NONE, 
+                                 stopbits=serial.STOPBITS_ONE, 
+                                 bytesize=serial.EIGHTBITS)
+
+    def read(self):
+        return self.ser.read(size=max(1, self.ser.in_waiting))
+
+    def fileno(self):
+        return self.ser.fileno()
+
+    def close(self):
+        self.ser.close()
+
+class FileTransport:
+    """Captured data, either as hex text like reference/capture_vkw.txt or raw bytes"""
+
+    def __init__(self, path, chunk_size=64):
+        self.data = loadCapture(path)
+        self.chunk_size = chunk_size
+        self.pos = 0
+
+    def read(self):
+        if self.pos >= len(self.data):
+            raise EOFError("End of capture")
+        chunk = self.data[self.pos:self.pos + self.chunk_size]
+        self.pos += len(chunk)
+        return chunk
+
+    def close(self):
+        pass
+
+class SimulatorTransport(SerialTransport):
+    """Pseudo-terminal replaying frames like the meter.
+
+    In realtime mode the frames are sent with the timing of the 2400 baud
+    line and one frame per interval, otherwise as fast as possible.
+    """
+
+    def __init__(self, frames, realtime=True, interval=5.0, count=None):
+        self.master, slave = pty.openpty()
+        tty.setraw(slave)
+        super().__init__(os.ttyname(slave))
+        os.close(slave)
+        self.frames = frames
+        self.realtime = realtime
+        self.interval = interval
+        self.count = count
+        self.thread = threading.Thread(target=self.replay, name="simulator", daemon=True)
+        self.thread.start()
+
+    def replay(self):
+        # 8N1: 10 bits per byte
+        bytes_per_chunk = config.serial_baudrate // 100
+        sent = 0
+        try:
+            while self.count is None or sent < self.count:
+                frame = self.frames[sent % len(self.frames)]
+                started = time.monotonic()
+                if self.realtime:
+                    for pos in range(0, len(frame), bytes_per_chunk):
+                        os.write(self.master, frame[pos:pos + bytes_per_chunk])
+                        time.sleep(0.1)
+                    time.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+                else:
+                    os.write(self.master, frame)
+                sent += 1
+        except OSError:
+            # reader side closed
+            pass
+
+    def close(self):
+        super().close()
+        os.close(self.master)
+
+def loadCapture(path):
+    """Read captured bytes from a hex dump or a binary file"""
+    with open(path, "rb") as capture_file:
+        content = capture_file.read()
+    try:
+        return bytes.fromhex(content.decode("ascii"))
+    except ValueError:
+        return content
+
+def loadCaptureFrames(path):
+    """Split a capture into the messages sent by the meter"""
+    framer = MbusFramer()
+    framer.feed(loadCapture(path))
+    return list(framer.frames)
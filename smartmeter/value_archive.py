@@ -0,0 +1,287 @@
+#######################################
+#
+# value_archive.py
+#
+# Full resolution archive of the numeric values of every frame.
+#
+# One segment file per meter and day is written to persistent storage.
+# Rows are collected in array backed columns (int64 values and a bitmap
+# of the missing values) and appended as a block once block_rows rows
+# are complete. Inside a block every column is
+# delta encoded and stored as varints, so a frame takes a few bytes
+# instead of a database row.
+#
+# Segment file layout:
+#   file header  : b'SMAR', version, field count, (name length, name) per field
+#   block header : b'SMAB', rows, first second, last second, column count,
+#                  byte length of every column
+#   block data   : timestamp column (seconds of the day, delta encoded),
+#                  one column per field (values * 100, delta encoded,
+#                  0 marks a missing value)
+#
+#######################################
+
+from array import array
+from datetime import datetime, timedelta
+import mmap
+import os
+import struct
+
+file_magic = b'SMAR'
+block_magic = b'SMAB'
+archive_version = 1
+value_scale = 100
+
+block_header = struct.Struct("<4sHIIB")
+
+#######################################
+# Encoding
+
+def encodeVarint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def decodeVarint(buffer, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = buffer[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+def encodeColumn(values, missing=None):
+    # deltas to the previous present value, zigzag encoded, shifted by one.
+    # missing is a bitmap with a set bit for every row without a value
+    out = bytearray()
+    previous = 0
+    for row, value in enumerate(values):
+        if missing is not None and missing[row >> 3] >> (row & 7) & 1:
+            out.append(0)
+            continue
+        delta = value - previous
+        previous = value
+        encodeVarint(out, ((delta << 1) ^ (delta >> 63)) + 1)
+    return out
+
+def decodeColumn(buffer, pos, rows):
+    values = []
+    previous = 0
+    for i in range(rows):
+        encoded, pos = decodeVarint(buffer, pos)
+        if encoded == 0:
+            values.append(None)
+            continue
+        encoded -= 1
+        previous += (encoded >> 1) ^ -(encoded & 1)
+        values.append(previous)
+    return values
+
+def encodeHeader(fields):
+    header = bytearray(file_magic)
+    header.append(archive_version)
+    header.append(len(fields))
+    for name in fields:
+        encoded = name.encode("utf-8")
+        header.append(len(encoded))
+        header += encoded
+    return bytes(header)
+
+def decodeHeader(buffer):
+    if buffer[:4] != file_magic or buffer[4] != archive_version:
+        raise Exception("Not a value archive segment")
+    fields = []
+    pos = 6
+    for i in range(buffer[5]):
+        length = buffer[pos]
+        fields.append(bytes(buffer[pos + 1:pos + 1 + length]).decode("utf-8"))
+        pos += 1 + length
+    return fields, pos
+
+def iterateBlocks(buffer, pos):
+    """Yield (position of column data, rows, first second, last second, column lengths) of complete blocks"""
+    end = len(buffer)
+    while pos + block_header.size <= end:
+        magic, rows, first_second, last_second, columns = block_header.unpack_from(buffer, pos)
+        if magic != block_magic:
+            return
+        lengths_pos = pos + block_header.size
+        data_pos = lengths_pos + 4 * columns
+        if data_pos > end:
+            return
+        lengths = struct.unpack_from(f"<{columns}I", buffer, lengths_pos)
+        block_end = data_pos + sum(lengths)
+        if block_end > end:
+            # torn block of an interrupted write
+            return
+        yield data_pos, rows, first_second, last_second, lengths
+        pos = block_end
+
+#######################################
+# Writer
+
+class SegmentWriter:
+    """Appends blocks to the segment file of one meter and day"""
+
+    def __init__(self, path, fields, day):
+        self.path = path
+        self.fields = fields
+        self.day = day
+        self.clear()
+
+        header = encodeHeader(fields)
+        if os.path.exists(path):
+            with open(path, "rb") as segment_file:
+                content = segment_file.read()
+            if content[:len(header)] != header:
+                raise Exception(f"Fields of {path} do not match")
+            # drop a torn block at the end of the file
+            valid_end = len(header)
+            for data_pos, rows, first_second, last_second, lengths in iterateBlocks(content, len(header)):
+                valid_end = data_pos + sum(lengths)
+            if valid_end != len(content):
+                with open(path, "r+b") as segment_file:
+                    segment_file.truncate(valid_end)
+        else:
+            with open(path, "wb") as segment_file:
+                segment_file.write(header)
+
+    def clear(self):
+        self.timestamps = array("I")
+        self.columns = [array("q") for field in self.fields]
+        self.missing = [bytearray() for field in self.fields]
+
+    def append(self, second, values):
+        row = len(self.timestamps)
+        self.timestamps.append(second)
+        if row & 7 == 0:
+            for missing in self.missing:
+                missing.append(0)
+        for column, missing, value in zip(self.columns, self.missing, values):
+            if value is None:
+                missing[row >> 3] |= 1 << (row & 7)
+                value = 0
+            column.append(value)
+
+    def flush(self):
+        if len(self.timestamps) == 0:
+            return
+        encoded = [encodeColumn(self.timestamps)]
+        for column, missing in zip(self.columns, self.missing):
+            encoded.append(encodeColumn(column, missing))
+
+        block = bytearray(block_header.pack(block_magic, len(self.timestamps),
+                                            self.timestamps[0], self.timestamps[-1], len(encoded)))
+        block += struct.pack(f"<{len(encoded)}I", *[len(column) for column in encoded])
+        for column in encoded:
+            block += column
+        with open(self.path, "ab") as segment_file:
+            segment_file.write(block)
+
+        self.clear()
+
+class ValueArchive:
+    """Archive of the numeric values of all frames, one segment per meter and day"""
+
+    def __init__(self, directory, fields, block_rows=120):
+        self.directory = directory
+        self.fields = fields
+        self.block_rows = block_rows
+        self.segments = {}
+
+    def write(self, json_current):
+        timestamp = json_current["Datum"]["value"]
+        meter_number = json_current.get("Zaehlernummer", {}).get("value") or "unknown"
+        day = timestamp.date()
+
+        segment = self.segments.get(meter_number)
+        if segment is None or segment.day != day:
+            if segment is not None:
+                segment.flush()
+            segment = self.openSegment(meter_number, day)
+            self.segments[meter_number] = segment
+
+        values = []
+        for name in self.fields:
+            value = json_current.get(name, {}).get("value")
+            values.append(None if value is None else int(round(value * value_scale)))
+        second = timestamp.hour * 3600 + timestamp.minute * 60 + timestamp.second
+        segment.append(second, values)
+
+        if len(segment.timestamps) >= self.block_rows:
+            segment.flush()
+
+    def openSegment(self, meter_number, day):
+        meter_directory = os.path.join(self.directory, meter_number)
+        os.makedirs(meter_directory, exist_ok=True)
+        return SegmentWriter(os.path.join(meter_directory, f"{day.isoformat()}.seg"), self.fields, day)
+
+    def flush(self):
+        for segment in self.segments.values():
+            segment.flush()
+
+    def close(self):
+        self.flush()
+        self.segments = {}
+
+#######################################
+# Reader
+
+class SegmentReader:
+    """Memory mapped reader of one segment file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.day = datetime.strptime(os.path.basename(path)[:10], "%Y-%m-%d")
+        with open(path, "rb") as segment_file:
+            self.buffer = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.fields, self.data_start = decodeHeader(self.buffer)
+
+    def read(self, start=None, end=None):
+        """Return the columns of all rows between start and end (datetimes, inclusive)"""
+        first = 0 if start is None else (start - self.day).total_seconds()
+        last = 86400 if end is None else (end - self.day).total_seconds()
+        result = {"timestamp": []}
+        for name in self.fields:
+            result[name] = []
+
+        for data_pos, rows, first_second, last_second, lengths in iterateBlocks(self.buffer, self.data_start):
+            # blocks outside of the range are skipped without decoding
+            if last_second < first or first_second > last:
+                continue
+            seconds = decodeColumn(self.buffer, data_pos, rows)
+            selected = [i for i, second in enumerate(seconds) if first <= second <= last]
+            pos = data_pos + lengths[0]
+            result["timestamp"].extend(self.day + timedelta(seconds=seconds[i]) for i in selected)
+            for name, length in zip(self.fields, lengths[1:]):
+                column = decodeColumn(self.buffer, pos, rows)
+                result[name].extend(None if column[i] is None else column[i] / value_scale for i in selected)
+                pos += length
+        return result
+
+    def close(self):
+        self.buffer.close()
+
+def readArchive(directory, meter_number, start, end):
+    """Read the columns of a meter between start and end across day segments"""
+    result = None
+    day = start.date()
+    while day <= end.date():
+        path = os.path.join(directory, meter_number, f"{day.isoformat()}.seg")
+        if os.path.exists(path):
+            reader = SegmentReader(path)
+            try:
+                columns = reader.read(start, end)
+            finally:
+                reader.close()
+            if result is None:
+                result = columns
+            else:
+                for name, values in columns.items():
+                    result.setdefault(name, []).extend(values)
+        day += timedelta(days=1)
+    return result or {"timestamp": []}